@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 DEBUG   = int(os.environ.get("DEBUG", True))
 TESTING = int(os.environ.get("TESTING", False))
@@ -28,6 +29,40 @@ MAIL_SERVER = os.getenv('MAIL_SERVER', '')
 MAIL_PORT = int(os.getenv('MAIL_PORT', 465))
 MAIL_USE_SSL = int(os.getenv('MAIL_USE_SSL', True))
 
+# mail dispatcher (gifoff/mail.py): worker threads per process, queue bound, messages per SMTP
+# session, and retries of a failed batch starting MAIL_RETRY_BACKOFF seconds apart and doubling
+MAIL_WORKERS = int(os.getenv('MAIL_WORKERS', 2))
+MAIL_QUEUE_SIZE = int(os.getenv('MAIL_QUEUE_SIZE', 500))
+MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', 20))
+MAIL_RETRIES = int(os.getenv('MAIL_RETRIES', 3))
+MAIL_RETRY_BACKOFF = float(os.getenv('MAIL_RETRY_BACKOFF', 2.0))
+
+# notification outbox (gifoff/outbox.py): drain it from the web process after each commit, or set
+# OUTBOX_AUTODRAIN=0 and run `flask drain-outbox --watch` as a worker. Failed rows are retried
+# OUTBOX_RETRY_BACKOFF seconds later, doubling, up to OUTBOX_MAX_ATTEMPTS sends. Hourly and daily
+# digests go out from the same drainer, OUTBOX_BATCH_SIZE readers per SMTP session, and retry the same way.
+OUTBOX_AUTODRAIN = int(os.getenv('OUTBOX_AUTODRAIN', True))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+# seconds a drainer may hold a claimed row before another process takes it over
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', 5*60))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETRY_BACKOFF = int(os.getenv('OUTBOX_RETRY_BACKOFF', 60))
+# how often the drainer looks for retries and digests that came due without a kick
+OUTBOX_POLL_INTERVAL = int(os.getenv('OUTBOX_POLL_INTERVAL', 60))
+# digests only read rows this many seconds old; keep it above the longest request transaction
+OUTBOX_DIGEST_LAG = int(os.getenv('OUTBOX_DIGEST_LAG', 60))
+# longest a held row (close()'s mail, waiting on fragment warm-up) waits before it's sent anyway
+OUTBOX_HOLD = int(os.getenv('OUTBOX_HOLD', 10*60))
+# links in mail written outside a request
+OUTBOX_BASE_URL = os.getenv('OUTBOX_BASE_URL', 'http://localhost/')
+
+# challenge status (gifoff/lifecycle.py): a thread in the web process moves challenges on at their
+# start and end times, or set CHALLENGE_AUTOTICK=0 and run `flask tick` from cron. Judges get a
+# reminder through the outbox when their challenge ends.
+CHALLENGE_AUTOTICK = int(os.getenv('CHALLENGE_AUTOTICK', True))
+CHALLENGE_TICK_INTERVAL = int(os.getenv('CHALLENGE_TICK_INTERVAL', 60))
+CHALLENGE_JUDGE_REMINDERS = int(os.getenv('CHALLENGE_JUDGE_REMINDERS', True))
+
 # app settings
 APP_NAME = os.getenv('APP_NAME', '')
 APP_ADMIN = os.getenv('APP_ADMIN', '')
@@ -41,6 +76,63 @@ SECURITY_REGISTERABLE = os.getenv('SECURITY_REGISTERABLE', True)
 SECURITY_CONFIRMABLE = os.getenv('SECURITY_CONFIRMABLE', True)
 SECURITY_RECOVERABLE = os.getenv('SECURITY_RECOVERABLE', True)
 
+# Flask-Caching backend, shared by every worker process. 'redis' (CACHE_REDIS_URL, a
+# unix:///path/to/redis.sock socket works too) or 'memcached' (CACHE_MEMCACHED_SERVERS) in
+# production; 'filesystem' under CACHE_DIR is the single-box and test stand-in. 'simple' is
+# per process and only fit for a single worker.
+CACHE_TYPE = os.getenv('CACHE_TYPE', 'filesystem')
+CACHE_DIR = os.getenv('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'gifoff-cache'))
+CACHE_THRESHOLD = int(os.getenv('CACHE_THRESHOLD', 5000))
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+CACHE_MEMCACHED_SERVERS = [s for s in os.getenv('CACHE_MEMCACHED_SERVERS', '').split(',') if s] or None
+CACHE_KEY_PREFIX = os.getenv('CACHE_KEY_PREFIX', 'gifoff_')
+CACHE_DEFAULT_TIMEOUT = int(os.getenv('CACHE_DEFAULT_TIMEOUT', 300))
+
+# group and challenge fragments; commits invalidate them (gifoff/invalidation.py), so this only bounds dead keys
+CACHE_FRAGMENT_TIMEOUT = int(os.getenv('CACHE_FRAGMENT_TIMEOUT', 60*60*24*30))
+
+# single-flight rebuilds by cache name prefix, see gifoff/cache.py: 'wait' for the rebuilding
+# request, or serve the previous 'stale' value meanwhile. Right after a close 'stale' would show
+# the pre-close board while the warm-up renders, so these wait.
+CACHE_SINGLE_FLIGHT = {'leaderboard': 'wait', 'leaders': 'wait', 'entries': 'wait'}
+CACHE_SINGLE_FLIGHT_WAIT = float(os.getenv('CACHE_SINGLE_FLIGHT_WAIT', 2.0))
+CACHE_SINGLE_FLIGHT_LOCK = int(os.getenv('CACHE_SINGLE_FLIGHT_LOCK', 30))
+
+# TrueSkill environment overrides, e.g. {'draw_probability': 0.0}
+TRUESKILL = {}
+
+# 'numpy' rates free-for-all challenges with gifoff.ffa (needs numpy installed), 'trueskill' uses the reference library
+RATING_BACKEND = os.getenv('RATING_BACKEND', 'trueskill')
+
+# challenges per group whose full rating history `flask compact-ratings` leaves in ffa_rating
+FFA_RATING_KEEP = int(os.getenv('FFA_RATING_KEEP', 20))
+
+# entry URL checks (gifoff/gifs.py): (connect, read) timeouts in seconds, how long a result is
+# remembered in each worker, the pooled connections kept per host and the most bytes read per
+# check for metadata
+GIF_CHECK_TIMEOUT = (float(os.getenv('GIF_CHECK_CONNECT_TIMEOUT', 3.05)), float(os.getenv('GIF_CHECK_READ_TIMEOUT', 5)))
+# seconds a whole check may take, however slowly the host sends
+GIF_CHECK_DEADLINE = float(os.getenv('GIF_CHECK_DEADLINE', 10))
+GIF_CHECK_TTL = int(os.getenv('GIF_CHECK_TTL', 60*60))
+GIF_CHECK_FAILURE_TTL = int(os.getenv('GIF_CHECK_FAILURE_TTL', 60))
+GIF_CHECK_POOL_SIZE = int(os.getenv('GIF_CHECK_POOL_SIZE', 10))
+GIF_CHECK_BYTES = int(os.getenv('GIF_CHECK_BYTES', 64*1024))
+
+# entries bigger than this get flagged to players and the judge
+GIF_OVERSIZE_BYTES = int(os.getenv('GIF_OVERSIZE_BYTES', 8*1024*1024))
+
+# local copies of entry GIFs and their posters (gifoff/gifstore.py), served with send_file; set
+# USE_X_SENDFILE = True when a front end server can send GIF_STORE_DIR files itself
+GIF_STORE_DIR = os.getenv('GIF_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'gifs'))
+GIF_STORE_MAX_BYTES = int(os.getenv('GIF_STORE_MAX_BYTES', 20*1024*1024))
+GIF_STORE_CACHE_TIMEOUT = int(os.getenv('GIF_STORE_CACHE_TIMEOUT', 60*60*24*365))
+# threads per process downloading saved entries, and how many saves may wait for them
+GIF_STORE_WORKERS = int(os.getenv('GIF_STORE_WORKERS', 2))
+GIF_STORE_QUEUE_SIZE = int(os.getenv('GIF_STORE_QUEUE_SIZE', 200))
+# background jobs requests hand off (gifoff/tasks.py), such as close()'s fragment warm-up
+TASK_WORKERS = int(os.getenv('TASK_WORKERS', 2))
+TASK_QUEUE_SIZE = int(os.getenv('TASK_QUEUE_SIZE', 100))
+
 GOOGLE_SITE_VERIFICATION = os.getenv('GOOGLE_SITE_VERIFICATION', '')
 GOOGLE_ANALYTICS = os.getenv('GOOGLE_ANALYTICS', '')
 
@@ -26,7 +26,11 @@ class CommonModelView(ModelView):
 class UserModelView(CommonModelView):
     form_excluded_columns = CommonModelView.form_excluded_columns + ('password',
                              'reset_password_token',
-                             'confirmed_at')
+                             'confirmed_at',
+                             'digest_outbox_id',
+                             'digest_claim',
+                             'digest_attempts',
+                             'digest_until')
 
     column_searchable_list = ['email', 'username']
     column_exclude_list = ['password', 'reset_password_token']
@@ -48,7 +52,10 @@ views = [
     dict(view=_m.Prompt, cls=CommonModelView),
     dict(view=_m.Entry, cls=CommonModelView),
     dict(view=_m.FFARating, cls=CommonModelView),
+    dict(view=_m.FFARatingCheckpoint, cls=CommonModelView),
     dict(view=_m.Rating, cls=CommonModelView),
+    dict(view=_m.GroupPlayerStats, cls=CommonModelView),
+    dict(view=_m.Outbox, cls=CommonModelView),
 #     dict(view=_m.Tournament, cls=CommonModelView),
 #     dict(view=_m.TournamentPlayers, cls=CommonModelView),
 #     dict(view=_m.TournamentRound, cls=CommonModelView),
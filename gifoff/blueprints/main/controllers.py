@@ -1,18 +1,25 @@
+import os
 from uuid import uuid4
 from random import shuffle
 
 import arrow
-import trueskill
 
-from flask import Blueprint, url_for, render_template, request, redirect, abort, flash, current_app, jsonify
-from flask_mail import Message
+from flask import Blueprint, url_for, render_template, request, redirect, abort, flash, current_app, jsonify, send_file
 from flask_security import current_user, login_required, roles_required
 
+from sqlalchemy import func
+
 from .helpers import IDSlugConverter, add_app_url_map_converter
-from ...cache import cache, clear_keys
-from ...forms import GroupForm, ChallengeEntry, ChallengeForm, PromptForm
-from ...mail import send_async_email
-from ...models import db, db_commit, User, Group, Challenge, Entry, Prompt, Rating, FFARating
+from ...cache import cache, generation
+from ...helpers import conditional
+from ...forms import GroupForm, ChallengeEntry, ChallengeForm, PromptForm, NotificationsForm
+from ...gifstore import gifstore
+from ...mail import dispatcher
+from ...lifecycle import scheduler
+from ...outbox import notify, release, drainer, set_notifications
+from ...models import db, db_commit, OPEN, User, Group, Challenge, Entry, Prompt, Rating, FFARating, GroupPlayerStats
+from ...ratings import rate_challenge
+from ...tasks import background
 
 Blueprint.add_app_url_map_converter = add_app_url_map_converter
 
@@ -33,38 +40,103 @@ def check_access(group):
             abort(401)
 
 
+def index_challenges(group_ids, user_id):
+    challenges = Challenge.query.filter(Challenge.group_id.in_(group_ids))
+
+    c = dict()
+    c['judging'] = challenges.filter(Challenge.judge_id == user_id, Challenge.status.in_(OPEN)).order_by(
+        Challenge.utc_end_time)
+    c['active'] = challenges.filter(Challenge.judge_id != user_id, Challenge.status.in_(OPEN)).order_by(
+        Challenge.utc_end_time)
+    c['recent'] = challenges.filter(Challenge.status == 'complete').order_by(Challenge.date_modified.desc()).limit(5)
+
+    return c
+
+
+def group_challenges(group_id):
+    challenges = Challenge.query.filter(Challenge.group_id == group_id).order_by(Challenge.date_modified.desc())
+
+    c = dict()
+    c['active'] = challenges.filter(Challenge.status.in_(OPEN))
+    c['recent'] = challenges.filter(Challenge.status == 'complete').limit(5)
+
+    return c
+
+
+def warm_fragments(challenge_id):
+    """ Render the cached fragments a closed challenge made stale, so the first visitor doesn't. """
+    challenge = Challenge.query.get(challenge_id)
+    group = challenge.group
+
+    render_template('main/partials/entries.html', challenge=challenge)
+
+    for partial in ('leaders', 'recent', 'leaderboard'):
+        render_template('main/partials/{}.html'.format(partial), group=group, challenges=group_challenges(group.id))
+
+
+def announce_winner(challenge_id, row_id, base_url):
+    """ Background half of close(): warm the group and challenge pages, then release the held mail. """
+    try:
+        with current_app.test_request_context(base_url=base_url):
+            warm_fragments(challenge_id)
+    except Exception:
+        current_app.logger.exception('Warming fragments for challenge {} failed'.format(challenge_id))
+
+    release(row_id)
+    drainer.kick()
+
+
+# Validators for conditional GETs: cache generations cover every commit that touches
+# what the page shows, the newest date_modified becomes Last-Modified.
+
+def group_validator(group_id):
+    last_modified = db.session.query(func.max(Challenge.date_modified))\
+                              .filter(Challenge.group_id == group_id).scalar()
+
+    return [generation('group', group_id)], last_modified
+
+
+def challenge_validator(challenge_id, group_id=None):
+    challenge = Challenge.query.get_or_404(challenge_id)
+
+    entries_modified = db.session.query(func.max(Entry.date_modified))\
+                                 .filter(Entry.challenge_id == challenge.id).scalar()
+
+    return [generation('challenge', challenge.id), generation('group', challenge.group_id)], \
+        max(filter(None, [challenge.date_modified, entries_modified]))
+
+
+def entry_validator(challenge_id, user_id):
+    challenge = Challenge.query.get_or_404(challenge_id)
+
+    last_modified = db.session.query(func.max(Entry.date_modified))\
+                              .filter(Entry.challenge_id == challenge.id, Entry.player_id == user_id).scalar()
+
+    return [generation('challenge', challenge.id)], last_modified or challenge.date_modified
+
+
 @main.route('')
 def index():
     c = dict()
     if current_user.is_authenticated:
-        challenges = Challenge.query.filter(Challenge.group_id.in_([g.id for g in current_user.player_of]))
-
-        c['judging'] = challenges.filter(Challenge.judge == current_user, Challenge.winner_id == None).order_by(
-            Challenge.utc_end_time)
-        c['active'] = challenges.filter(Challenge.judge != current_user, Challenge.winner_id == None).order_by(
-            Challenge.utc_end_time)
-        c['recent'] = challenges.filter(Challenge.winner_id != None).order_by(Challenge.date_modified.desc()).limit(5)
+        c = index_challenges([g.id for g in current_user.player_of], current_user.id)
 
     return render_template('main/index.html', challenges=c)
 
 
 @main.route('<id_slug:group_id>')
 @login_required
+@conditional(group_validator)
 def group(group_id):
     group = Group.query.get_or_404(group_id)
     check_access(group)
 
-    challenges = Challenge.query.filter(Challenge.group_id == group.id).order_by(Challenge.date_modified.desc())
-
-    c = dict()
-    c['active'] = challenges.filter(Challenge.winner_id == None)
-    c['recent'] = challenges.filter(Challenge.winner_id != None).limit(5)
-
-    return render_template('main/group.html', group=group, challenges=c)
+    return render_template('main/group.html', group=group, challenges=group_challenges(group.id))
 
 
 @main.route('<id_slug:group_id>/<id_slug:challenge_id>', methods=['GET', 'POST'])
 @login_required
+@conditional(challenge_validator)
 def challenge(group_id, challenge_id):
     challenge = Challenge.query.get_or_404(challenge_id)
     check_access(challenge.group)
@@ -72,7 +144,7 @@ def challenge(group_id, challenge_id):
     if challenge.active and current_user not in [challenge.author, challenge.judge]:
         return redirect(url_for('main.enter', challenge_id=challenge))
     elif current_user == challenge.judge:
-        entries = challenge.players
+        entries = list(challenge.players)
         shuffle(entries)
 
     else:
@@ -97,26 +169,69 @@ def enter(challenge_id):
         flash('You cannot enter, you are the judge.', 'danger')
         return redirect(url_for('main.challenge', group_id=challenge.group, challenge_id=challenge))
 
-    forms = dict()
-    for p in challenge.prompts:
-        f = ChallengeEntry(prompt_id=p.id, url=p.user_entry(current_user).url, entry_id=p.user_entry(current_user).id)
-        if f.validate_on_submit():
-            entry = Entry.query.get(int(f.entry_id.data))
-            entry.url = f.url.data
-            if db_commit():
-                return jsonify({'response': 'OK', 'prompt_id': f.prompt_id.data, 'url': entry.url}), 200
-            else:
-                return jsonify({'response': 'ERROR', 'prompt_id': f.prompt_id.data}), 304
-        elif f.errors:
-            return jsonify({'response': 'ERROR', 'errors': f.errors, 'prompt_id': f.prompt_id.data}), 200
+    if request.method == 'POST':
+        return save_entry(challenge)
+
+    entries = challenge.user_entries(current_user)
+    forms = {p.id: ChallengeEntry(formdata=None, prompt_id=p.id, url=entries[p.id].url) for p in challenge.prompts}
+
+    return render_template('main/enter.html', challenge=challenge, forms=forms, entries=entries)
+
+
+def save_entry(challenge):
+    """ The AJAX save from enter(): one prompt's form, validated (and its URL fetched) once. """
+    f = ChallengeEntry()
+
+    try:
+        prompt_id = int(f.prompt_id.data)
+    except (TypeError, ValueError):
+        abort(400)
+
+    # always the current user's own entry, whatever ids the client posted
+    entry = Entry.query.filter(Entry.challenge_id==challenge.id, Entry.prompt_id==prompt_id,
+                               Entry.player_id==current_user.id).first_or_404()
+
+    if not f.validate_on_submit():
+        return jsonify({'response': 'ERROR', 'errors': f.errors, 'prompt_id': prompt_id}), 200
+
+    if entry.url != f.url.data:
+        entry.url = f.url.data
+        entry.digest = None
+
+    if getattr(f.url, 'gif', None):
+        entry.set_gif(f.url.gif)
+
+    if db_commit():
+        if entry.digest is None:
+            gifstore.submit(entry.id, entry.url)
+
+        return jsonify({'response': 'OK', 'prompt_id': prompt_id, 'url': entry.url,
+                        'width': entry.width, 'height': entry.height, 'frames': entry.frames,
+                        'size': entry.size, 'oversized': entry.oversized}), 200
+    else:
+        return jsonify({'response': 'ERROR', 'prompt_id': prompt_id}), 304
+
+
+@main.route('gifs/<digest>/<any(animated, poster):kind>.gif')
+@login_required
+def stored_gif(digest, kind):
+    path = gifstore.path(digest, kind)
+    if path is None or not os.path.exists(path):
+        abort(404)
 
-        forms[p.id] = f
+    # content addressed, so a digest's bytes never change
+    response = send_file(path, mimetype='image/gif', conditional=True,
+                         cache_timeout=current_app.config['GIF_STORE_CACHE_TIMEOUT'])
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.headers['Cache-Control'] += ', immutable'
 
-    return render_template('main/enter.html', challenge=challenge, forms=forms)
+    return response
 
 
 @main.route('<id_slug:challenge_id>/entry/<int:user_id>', methods=['GET', 'POST'])
 @login_required
+@conditional(entry_validator)
 def entry(challenge_id, user_id):
     challenge = Challenge.query.get_or_404(challenge_id)
     check_access(challenge.group)
@@ -132,8 +247,13 @@ def score(challenge_id, entry_id, score):
     challenge = Challenge.query.get_or_404(challenge_id)
 
     if current_user == challenge.judge:
-        entry = Entry.query.get_or_404(entry_id)
-        entry.score = float(score)
+        entry = Entry.query.filter(Entry.id == entry_id, Entry.challenge_id == challenge.id).first_or_404()
+        old, entry.score = entry.score, float(score)
+
+        # closed challenges are already in the group totals
+        if challenge.complete:
+            GroupPlayerStats.record_score(challenge, entry.player_id, entry.score - (old or 0))
+
         if db_commit():
             return jsonify({'response': 'OK'}), 200
         else:
@@ -148,53 +268,26 @@ def close(challenge_id):
     challenge = Challenge.query.get_or_404(challenge_id)
 
     if current_user == challenge.judge:
-        max_score, winner = challenge.high_score
+        if challenge.complete:
+            flash('Challenge already completed.', 'info')
+            return redirect(url_for('main.challenge', group_id=challenge.group, challenge_id=challenge))
+
+        board = challenge.scoreboard
+        max_score, winner = board.high_score
 
         if winner:
             challenge.winner = winner
             
-            if len(challenge.players) > 1:
-                ratings = sorted([(p, challenge.player_score(p), p.group_rating(challenge.group)) 
-                                   for p in challenge.players if challenge.player_score(p) > 0.0], key=lambda entry: entry[1], reverse=True)
-    
-                new_ratings = trueskill.rate([(r[2],) for r in ratings])
-                
-                player_ratings = zip([p[0] for p in ratings], [r[0] for r in new_ratings])
-                
-                for player, new_rating in player_ratings:
-                    player.update_group_rating(challenge, new_rating)
+            stats = GroupPlayerStats.record_challenge(challenge, board)
+            rate_challenge(challenge, board, stats)
+            # held until the fragments are warm, so no drainer sends it first
+            row = notify('challenge_completed', challenge, hold=True)
             
             if db_commit():
-                clear_keys(cache, ['leaders{}'.format(challenge.group.id),
-                                   'leaderboard{}'.format(challenge.group.id),
-                                   'recent{}'.format(challenge.group.id)]
-                           )
-                try:
-                    msg = Message(
-                        "{}: Challenge '{}' completed! Come see the winner".format(current_app.config['APP_NAME'],
-                                                                                   challenge.name),
-                        sender=(current_app.config['APP_NAME'], current_app.config['MAIL_DEFAULT_SENDER']),
-                        recipients=[current_user.email],
-                        bcc=[p.email for p in challenge.players])
-
-                    msg.body = "{} by {} has completed.\n".format(challenge.name, challenge.author.username)
-                    msg.body += "{} has humbly selected the winner to be... {} \n".format(challenge.judge.username,
-                                                                                          challenge.winner.username)
-                    msg.body += "---\n"
-                    msg.body += "See {}'s and everyone else's entries at: {}\n".format(challenge.winner.username,
-                                                                                       url_for('main.challenge',
-                                                                                               group_id=challenge.group,
-                                                                                               challenge_id=challenge,
-                                                                                               _external=True))
-                    msg.body += "---\n"
-                    msg.body += "Group Invite Link: {}".format(
-                        url_for('main.join_group', uuid=challenge.group.pin, _external=True))
-
-                    send_async_email(msg)
-
-                    flash('Mail sent, emails on their way!', 'success')
-                except Exception as e:
-                    flash('Mail send failed, send manually: {}'.format(e), 'danger')
+                if not background.submit(announce_winner, challenge.id, row.id, request.url_root):
+                    release(row.id)
+                    drainer.kick()
+                flash('Winner announced, emails are queued!', 'success')
         else:
             flash('No Winner Identified.', 'danger')
 
@@ -208,7 +301,14 @@ def delete_challenge(challenge_id):
 
     if current_user in [challenge.group.owner, challenge.author]:
         group = challenge.group
+        complete = challenge.complete
         db.session.delete(challenge)
+
+        if complete:
+            # take its entries, win and ratings back out of the group totals
+            db.session.flush()
+            GroupPlayerStats.rebuild(group)
+
         if db_commit():
             flash('Challenge Deleted', 'success')
             return redirect(url_for('main.group', group_id=group))
@@ -260,28 +360,12 @@ def new_challenge(group_id):
         ps = [Prompt(challenge=c, prompt=p) for p in request.form.getlist('prompts') if p != '']
         db.session.add_all(ps)
 
+        notify('challenge_created', c)
+
         if db_commit():
-            try:
-                msg = Message("New Challenge Posted to {} at {}".format(group.name, current_app.config['APP_NAME']),
-                              sender=(current_app.config['APP_NAME'], current_app.config['MAIL_DEFAULT_SENDER']),
-                              recipients=[current_app.config['MAIL_DEFAULT_SENDER']],
-                              bcc=[p.email for p in group.players])
-
-                msg.body = "New Challenge by {}: '{}'\n".format(current_user.username, c.name)
-                msg.body += "{}\n".format(c.description)
-                msg.body += "---\n"
-                msg.body += "The challenge starts at {} ({}) and will be judged by {}.\n".format(
-                    st.format('YYYY-MM-DD HH:mm'), current_app.config['DEFAULT_TIMEZONE'], c.judge.username)
-                msg.body += "Get Started: {}\n".format(
-                    url_for('main.challenge', group_id=group, challenge_id=c, _external=True))
-                msg.body += "---\n"
-                msg.body += "Group Invite Link: {}".format(url_for('main.join_group', uuid=group.pin, _external=True))
-
-                send_async_email(msg)
-
-                flash('Mail sent; Hurry up and add some prompts!', 'success')
-            except Exception as e:
-                flash('Mail send failed, send manually: {}'.format(e), 'danger')
+            drainer.kick()
+            scheduler.kick()
+            flash('Emails queued; Hurry up and add some prompts!', 'success')
 
             return redirect(url_for('main.challenge', group_id=group, challenge_id=c))
 
@@ -325,6 +409,7 @@ def edit_challenge(challenge_id):
         challenge.utc_end_time = arrow.get(et.naive, current_app.config['DEFAULT_TIMEZONE']).to('utc').datetime
 
         if db_commit():
+            scheduler.kick()
             return redirect(url_for('main.challenge', group_id=challenge.group, challenge_id=challenge))
 
     return render_template('main/edit_challenge.html', challenge=challenge, form=form, min_time=min_time)
@@ -450,9 +535,31 @@ def delete(model, model_id):
         abort(401)
 
 
+@main.route('notifications', methods=['GET', 'POST'])
+@login_required
+def notifications():
+    form = NotificationsForm(obj=current_user)
+    if form.validate_on_submit():
+        set_notifications(current_user, form.notifications.data)
+        if db_commit():
+            # a final digest may be due now
+            drainer.kick()
+            flash('Notification settings saved', 'success')
+            return redirect(url_for('main.notifications'))
+
+    return render_template('main/notifications.html', form=form)
+
+
 @main.route('clear-cache')
 @roles_required('ADMIN')
 def clear_cache():
     cache.clear()
     flash('Site cache cleared', 'success')
     return redirect(url_for('main.index'))
+
+
+@main.route('mail-queue')
+@roles_required('ADMIN')
+def mail_queue():
+    """ This worker process's mail dispatcher: queue depth and sent/failed/retried/dropped counts. """
+    return jsonify(dispatcher.stats()), 200
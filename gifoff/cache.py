@@ -1,7 +1,131 @@
+from time import time, sleep
+
+from flask import current_app
 from flask_caching import Cache, make_template_fragment_key
+from flask_caching.jinja2ext import CacheExtension, JINJA_CACHE_ATTR_NAME
+
+from .memo import store
+
+# backend comes from the CACHE_* settings in config.py; init_cache() installs the {% cache %} tag
+cache = Cache(with_jinja2_ext=False)
+
+
+def init_cache(app):
+    cache.init_app(app)
 
-cache = Cache(config={'CACHE_TYPE': 'simple'})
+    setattr(app.jinja_env, JINJA_CACHE_ATTR_NAME, cache)
+    app.jinja_env.add_extension(SingleFlightCacheExtension)
+    app.add_template_global(generation)
 
 def clear_keys(cache, keys):
 	for key in keys:
-		cache.delete(make_template_fragment_key(key))
\ No newline at end of file
+		cache.delete(make_template_fragment_key(key))
+
+
+# Generations
+#
+# Cached fragments and data for a group or challenge carry its generation in their key.
+# Invalidating is one bump() in the shared backend, seen by every worker; stale entries
+# are never read again and age out on their own timeout.
+
+def generation_key(kind, id):
+    return 'generation_{}{}'.format(kind, id)
+
+
+def seed(key):
+    """ Start a missing counter from the clock, past any value it held before eviction or expiry. """
+    if cache.get(key) is None:
+        cache.cache.add(key, int(time() * 1000), timeout=0)
+
+
+def generation(kind, id):
+    """ Current generation of a 'group' or 'challenge', read once per request. """
+    seen = store('generations')
+    key = generation_key(kind, id)
+
+    if key not in seen:
+        seed(key)
+        seen[key] = cache.get(key)
+
+    return seen[key]
+
+
+def bump(kind, id):
+    """ Move a group or challenge to a new generation. """
+    key = generation_key(kind, id)
+
+    seed(key)
+    cache.cache.inc(key)
+
+    store('generations').pop(key, None)
+
+
+# Single flight
+#
+# When an expensive entry is missing, one request (or the post-close warm-up) takes a lock
+# in the shared backend and rebuilds it. CACHE_SINGLE_FLIGHT maps name prefixes to what
+# everyone else does meanwhile: 'wait' polls for the rebuilt value for up to
+# CACHE_SINGLE_FLIGHT_WAIT seconds, 'stale' serves the last value built under any
+# generation and only waits if there is none. Names without a rule rebuild independently.
+
+def flight_mode(name):
+    rules = current_app.config.get('CACHE_SINGLE_FLIGHT', {})
+    matches = [prefix for prefix in rules if name.startswith(prefix)]
+
+    return rules[max(matches, key=len)] if matches else None
+
+
+def fetch(name, key, build, timeout=None):
+    """ cache.get(key), rebuilding a miss with build() under the single-flight rule for `name`.
+
+    `name` identifies the entry across generations (e.g. 'leaderboard3'), `key` is the full key.
+    """
+    rv = cache.get(key)
+    if rv is not None:
+        return rv
+
+    mode = flight_mode(name)
+    if mode is None:
+        rv = build()
+        cache.set(key, rv, timeout=timeout)
+        return rv
+
+    stale_key = 'stale_{}'.format(name)
+    lock_key = 'lock_{}'.format(key)
+
+    if cache.cache.add(lock_key, 1, timeout=current_app.config.get('CACHE_SINGLE_FLIGHT_LOCK', 30)):
+        try:
+            rv = build()
+            cache.set(key, rv, timeout=timeout)
+            cache.set(stale_key, rv, timeout=timeout)
+        finally:
+            cache.delete(lock_key)
+        return rv
+
+    if mode == 'stale':
+        rv = cache.get(stale_key)
+        if rv is not None:
+            return rv
+
+    deadline = time() + current_app.config.get('CACHE_SINGLE_FLIGHT_WAIT', 2.0)
+    while time() < deadline:
+        sleep(0.05)
+        rv = cache.get(key)
+        if rv is not None:
+            return rv
+
+    # the rebuilding request is slow or gone; render for this request without caching
+    return build()
+
+
+class SingleFlightCacheExtension(CacheExtension):
+    """ The {% cache %} tag, with misses rebuilt through fetch(). """
+
+    def _cache(self, timeout, fragment_name, vary_on, caller):
+        key = make_template_fragment_key(fragment_name, vary_on=vary_on)
+
+        if timeout == "del":
+            cache.delete(key)
+            return caller()
+
+        return fetch(fragment_name, key, caller, timeout)
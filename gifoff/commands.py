@@ -0,0 +1,295 @@
+import re
+from datetime import datetime
+from time import time, sleep
+
+import click
+from flask_mail import Message
+from sqlalchemy import func
+
+from .models import db, db_commit, count_query, User, Group, Prompt, Entry, GroupPlayerStats, Outbox, \
+                    ChallengeScoreboard, Leaderboard
+from .blueprints.main.controllers import index_challenges, group_challenges
+from .ffa import benchmark, np, TOLERANCE
+from .gifs import gifs
+from .gifstore import store_entry
+from .lifecycle import tick, due_challenges
+from .mail import dispatcher, send_async_email
+from .outbox import drain_all, due_rows, claimed, digest_rows
+from .ratings import replay, final_ratings, write_replay, rating_env, compact_history
+
+# tables that grow with play and must never be read with a full scan
+HOT_TABLES = ('challenge', 'prompt', 'entry', 'ffa_rating', 'group_players', 'group_player_stats', 'outbox')
+
+
+def hot_queries():
+    """ The hot reads in models.py and the main controllers, built by the same helpers the views call.
+
+    Each shape is (name, query), or (name, query, tables) naming the hot tables it may read
+    with a full scan of a covering index.
+    """
+    now = datetime.utcnow()
+    index = index_challenges([1, 2], 1)
+    group = group_challenges(1)
+    board = Leaderboard(Group(id=1))
+
+    return [
+        ('index judging', index['judging']),
+        ('index active', index['active']),
+        ('index recent', index['recent']),
+        ('group active', group['active']),
+        ('group recent', group['recent']),
+        ('group active count', Group.challenge_count(1, ('upcoming', 'active'))),
+        ('challenges due', due_challenges(now)),
+        ('group last winner', Group.last_won(1).limit(1)),
+        ('challenge prompts', Prompt.ids_for(1)),
+        ('challenge scoreboard', ChallengeScoreboard.totals_query(1)),
+        ('challenge entry count', count_query(Entry, challenge_id=1)),
+        ('player entries', Entry.player_entries(1, 1)),
+        ('prompt high score', Prompt.best_score(1).limit(1)),
+        ('group leaders', Group(id=1).leaders(3)),
+        ('player stats', GroupPlayerStats.rows(1, [1])),
+        ('leaderboard players', board.players_query),
+        ('leaderboard history', board.history_query),
+        ('latest ratings', GroupPlayerStats.latest_ratings(1)),
+        ('user groups', Group.query.with_parent(User(id=1), 'player_of')),
+        ('outbox due', due_rows(now, 50)),
+        ('outbox claimed', claimed('x')),
+        ('digest rows', digest_rows('x')),
+    ]
+
+
+def full_scans(plan, allowed=()):
+    """ Hot tables read with a full scan in a SQLite EXPLAIN QUERY PLAN, even of an index,
+        except covering index scans of the `allowed` tables. """
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        words = detail.replace('TABLE ', '').split()
+        table = re.sub(r'_\d+$', '', words[1]) if len(words) > 1 else None  # aliases read as ffa_rating_1
+        if words[0] != 'SCAN' or table not in HOT_TABLES:
+            continue
+        if table in allowed and 'COVERING INDEX' in detail:
+            continue
+        scans.append(detail)
+
+    return scans
+
+
+def register_commands(app):
+
+    @app.cli.command('rebuild-stats')
+    @click.option('--group', 'group_id', type=int, default=None, help='Only rebuild this group id.')
+    def rebuild_stats(group_id):
+        """Recompute group player statistics from completed challenges."""
+        groups = Group.query.filter(Group.id==group_id) if group_id else Group.query
+
+        for group in groups:
+            rows = GroupPlayerStats.rebuild(group)
+            if db_commit():
+                click.echo('{}: {} players'.format(group.name, len(rows)))
+            else:
+                click.echo('{}: rebuild failed'.format(group.name), err=True)
+
+    @app.cli.command('explain-queries')
+    def explain_queries():
+        """Fail if a hot query plans a full scan of a growing table (SQLite)."""
+        if db.engine.name != 'sqlite':
+            raise click.ClickException('explain-queries reads SQLite query plans; point SQLALCHEMY_DATABASE_URI at SQLite.')
+
+        failures = 0
+        connection = db.engine.raw_connection()
+
+        for shape in hot_queries():
+            name, q, allowed = (shape + ((),))[:3]
+            compiled = q.statement.compile(dialect=db.engine.dialect)
+            params = [compiled.params[key] for key in compiled.positiontup]
+            plan = connection.cursor().execute('EXPLAIN QUERY PLAN ' + str(compiled), params).fetchall()
+
+            scans = full_scans(plan, allowed)
+            if scans:
+                failures += 1
+                click.echo('FAIL {}: {}'.format(name, '; '.join(scans)), err=True)
+            else:
+                click.echo('ok   {}'.format(name))
+
+        connection.close()
+
+        if failures:
+            raise SystemExit(1)
+
+    @app.cli.command('replay-ratings')
+    @click.option('--group', 'group_id', type=int, default=None, help='Only replay this group id.')
+    @click.option('--processes', type=int, default=None, help='Worker processes, defaults to one per CPU.')
+    @click.option('--dry-run', is_flag=True, help='Report rating changes without writing them.')
+    def replay_ratings(group_id, processes, dry_run):
+        """Rebuild FFARating history by replaying completed challenges."""
+        groups = dict(db.session.query(Group.id, Group.name).filter(Group.id==group_id) if group_id else
+                      db.session.query(Group.id, Group.name))
+
+        for g_id, rows in replay(sorted(groups), processes=processes):
+            if not dry_run:
+                write_replay(g_id, rows)
+                if db_commit():
+                    click.echo('{}: {} ratings written'.format(groups[g_id], len(rows)))
+                else:
+                    click.echo('{}: replay failed'.format(groups[g_id]), err=True)
+                continue
+
+            new = final_ratings(rows)
+            old = {s.player_id: s.rating for s in GroupPlayerStats.query.filter(GroupPlayerStats.group_id==g_id,
+                                                                                 GroupPlayerStats._mu!=None)}
+            names = dict(db.session.query(User.id, User.username).filter(User.id.in_(list(set(old) | set(new)) or [0])))
+
+            changed = 0
+            for player_id in sorted(set(old) | set(new), key=lambda p_id: names.get(p_id, '')):
+                old_mu = round(old[player_id].mu, 2) if player_id in old else None
+                new_mu = round(new[player_id][0], 2) if player_id in new else None
+                if old_mu != new_mu:
+                    changed += 1
+                    click.echo('  {}: {} -> {}'.format(names.get(player_id, player_id), old_mu, new_mu))
+
+            click.echo('{}: {} ratings, {} players would change'.format(groups[g_id], len(rows), changed))
+
+    @app.cli.command('compact-ratings')
+    @click.option('--group', 'group_id', type=int, default=None, help='Only compact this group id.')
+    @click.option('--keep', type=int, default=None, help='Challenges of full history to keep, defaults to FFA_RATING_KEEP.')
+    def compact_ratings(group_id, keep):
+        """Fold old FFARating history into per-player checkpoints."""
+        if keep is None:
+            keep = app.config.get('FFA_RATING_KEEP', 20)
+
+        groups = Group.query.filter(Group.id==group_id) if group_id else Group.query
+
+        for group in groups:
+            removed = compact_history(group.id, keep)
+            if db_commit():
+                click.echo('{}: {} ratings compacted'.format(group.name, removed))
+            else:
+                click.echo('{}: compaction failed'.format(group.name), err=True)
+
+    @app.cli.command('benchmark-ratings')
+    @click.option('--sizes', default='10,50,200', help='Comma separated player counts.')
+    @click.option('--repeat', type=int, default=5, help='Matches rated per size and backend.')
+    @click.option('--draw-probability', type=float, default=None, help='Override the configured draw probability.')
+    def benchmark_ratings(sizes, repeat, draw_probability):
+        """Time trueskill against the NumPy free-for-all backend."""
+        if np is None:
+            raise click.ClickException('benchmark-ratings needs numpy installed.')
+
+        params = dict(app.config.get('TRUESKILL', {}))
+        if draw_probability is not None:
+            params['draw_probability'] = draw_probability
+
+        env = rating_env(params, backend='trueskill')
+
+        def show(value, fmt):
+            return '-' if value is None else fmt.format(value)
+
+        row = '{:>8} {:>12} {:>12} {:>8} {:>10} {:>10}'
+        click.echo(row.format('players', 'trueskill', 'numpy', 'speedup', 'mu diff', 'sigma diff'))
+
+        drifted = []
+        for size, reference, fast, mu_diff, sigma_diff in benchmark([int(n) for n in sizes.split(',')], repeat, env):
+            if max(mu_diff or 0, sigma_diff or 0) > TOLERANCE:
+                drifted.append(size)
+
+            speedup = reference / fast if reference and fast else None
+            click.echo(row.format(size,
+                                  show(reference and reference * 1000, '{:.2f}ms'),
+                                  show(fast and fast * 1000, '{:.2f}ms'),
+                                  show(speedup, '{:.1f}x'),
+                                  show(mu_diff, '{:.1e}'),
+                                  show(sigma_diff, '{:.1e}')))
+
+        click.echo('- : out of float range for that match; large fields usually need --draw-probability 0')
+
+        if drifted:
+            raise click.ClickException('numpy ratings differ from trueskill by more than {} at {} players.'.format(
+                TOLERANCE, ', '.join(str(size) for size in drifted)))
+
+    @app.cli.command('check-gif')
+    @click.argument('urls', nargs=-1, required=True)
+    @click.option('--repeat', type=int, default=1, help='Check each URL this many times to see the result cache at work.')
+    def check_gif(urls, repeat):
+        """Run the entry URL validator against URLs, e.g. a local `python -m http.server`."""
+        for url in urls:
+            for _ in range(repeat):
+                started = time()
+                info = gifs.inspect(url)
+                click.echo('{:>9.1f}ms  {}  {}'.format((time() - started) * 1000, info.error or 'ok', url))
+
+            if not info.error:
+                click.echo('           {}x{}, {} frames in the first {} bytes, {} bytes'.format(
+                    info.width, info.height, info.frames, app.config['GIF_CHECK_BYTES'], info.size))
+
+    @app.cli.command('store-gifs')
+    @click.option('--challenge', 'challenge_id', type=int, default=None, help='Only entries of this challenge id.')
+    def store_gifs(challenge_id):
+        """Fetch entries saved before the local GIF store into it."""
+        q = db.session.query(Entry.id, Entry.url).filter(Entry.url!=None, Entry.digest==None).order_by(Entry.id)
+        if challenge_id:
+            q = q.filter(Entry.challenge_id==challenge_id)
+
+        stored = failed = 0
+        for entry_id, url in q.all():
+            if store_entry(entry_id, url):
+                stored += 1
+            else:
+                failed += 1
+                click.echo('entry {}: could not store {}'.format(entry_id, url), err=True)
+
+        click.echo('{} entries stored, {} failed'.format(stored, failed))
+
+    @app.cli.command('send-test-mail')
+    @click.argument('recipient')
+    @click.option('--count', type=int, default=1, help='Messages to queue at once.')
+    def send_test_mail(recipient, count):
+        """Queue test messages through the mail dispatcher and wait for them, e.g. against
+        `python -m smtpd -n -c DebuggingServer localhost:1025` with MAIL_SERVER/MAIL_PORT pointed at it."""
+        started = time()
+        for n in range(count):
+            send_async_email(Message('{} test mail {}/{}'.format(app.config['APP_NAME'], n + 1, count),
+                                     sender=(app.config['APP_NAME'], app.config['MAIL_DEFAULT_SENDER']),
+                                     recipients=[recipient],
+                                     body='Sent by flask send-test-mail.'))
+
+        click.echo('queued {} in {:.1f}ms, depth {}'.format(count, (time() - started) * 1000, dispatcher.depth))
+
+        if not dispatcher.flush(timeout=60):
+            click.echo('gave up waiting, {} still queued'.format(dispatcher.depth), err=True)
+
+        click.echo(' '.join('{}={}'.format(k, v) for k, v in sorted(dispatcher.stats().items())))
+        click.echo('{:.1f}ms total'.format((time() - started) * 1000))
+
+    @app.cli.command('drain-outbox')
+    @click.option('--batch', type=int, default=None, help='Rows per SMTP session, defaults to OUTBOX_BATCH_SIZE.')
+    @click.option('--watch', is_flag=True, help='Keep draining every --interval seconds.')
+    @click.option('--interval', type=float, default=5.0, help='Seconds between passes with --watch.')
+    def drain_outbox(batch, watch, interval):
+        """Send pending notification mail from the outbox table, and any digests that are due."""
+        while True:
+            sent, failed = drain_all(batch)
+            if sent or failed or not watch:
+                pending = db.session.query(func.count(Outbox.id)).filter(Outbox.status=='pending').scalar()
+                click.echo('{} sent, {} failed, {} pending'.format(sent, failed, pending))
+
+            if not watch:
+                return
+
+            db.session.remove()
+            sleep(interval)
+
+    @app.cli.command('tick')
+    @click.option('--watch', is_flag=True, help='Keep ticking every --interval seconds.')
+    @click.option('--interval', type=float, default=60.0, help='Seconds between ticks with --watch.')
+    def tick_challenges(watch, interval):
+        """Move challenges whose start or end time has passed to their new status."""
+        while True:
+            for challenge, old in tick():
+                click.echo('{} {}: {} -> {}'.format(challenge.id, challenge.name, old, challenge.status))
+
+            if not watch:
+                return
+
+            db.session.remove()
+            sleep(interval)
@@ -1,6 +1,31 @@
 import os
 
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
 from flask import Flask
+from sqlalchemy import inspect
+
+
+def init_schema(db, migrations):
+    """ Create an empty database at the newest migration; refuse one the migrations haven't brought up to date.
+
+    create_all() can only add missing tables, so running it against an older database would
+    leave tables the migrations then fail to create and columns nobody adds.
+    """
+    script = ScriptDirectory(migrations)
+
+    with db.engine.connect() as connection:
+        context = MigrationContext.configure(connection)
+
+        if not inspect(connection).get_table_names():
+            db.create_all()
+            context.stamp(script, 'head')
+            return
+
+        current, head = context.get_current_revision(), script.get_current_head()
+        if current != head:
+            raise RuntimeError('Database is at migration {} but the code needs {}: run `alembic upgrade head` '
+                               'before starting the app.'.format(current or 'none', head))
 
 
 def create_app():
@@ -37,11 +62,30 @@ def create_app():
     db.app = app
     db.init_app(app)
 
-    from ..cache import cache
-    cache.init_app(app)
+    from ..invalidation import register
+    register()
+
+    from ..cache import init_cache
+    init_cache(app)
 
-    from ..mail import mail
+    from ..mail import mail, dispatcher
     mail.init_app(app)  # Initialize Flask-Mail
+    dispatcher.init_app(app)
+
+    from ..outbox import drainer
+    drainer.init_app(app)
+
+    from ..lifecycle import scheduler
+    scheduler.init_app(app)
+
+    from ..gifs import gifs
+    gifs.init_app(app)
+
+    from ..gifstore import gifstore
+    gifstore.init_app(app)
+
+    from ..tasks import background
+    background.init_app(app)
 
     from flask_jsglue import JSGlue
     jsglue = JSGlue(app)
@@ -53,7 +97,7 @@ def create_app():
 #     from ..blueprints.tournament.controllers import tourney
 #     app.register_blueprint(tourney)
 
-    db.create_all()
+    init_schema(db, os.path.join(BASE_PATH, os.pardir, 'migrations'))
 
     # Setup Flask-Security
     from ..security import security, create_admin, ExtendedConfirmRegisterForm, ExtendedRegisterForm
@@ -70,4 +114,8 @@ def create_app():
     from ..admin import admin
     admin.init_app(app)
 
+    # CLI commands
+    from ..commands import register_commands
+    register_commands(app)
+
     return app
@@ -0,0 +1,239 @@
+"""Free-for-all TrueSkill on NumPy arrays.
+
+trueskill.rate builds a factor graph of Python objects and passes messages
+between them one at a time, which gets slow once a challenge has dozens of
+single-player teams. For that case every factor in a layer has the same shape,
+so FFATrueSkill keeps the messages in arrays and updates a whole layer per
+step. Anything else (multi-player teams, tied ranks, weights) is handed to the
+reference implementation, as is every call when NumPy is not installed.
+"""
+import math
+from timeit import default_timer
+
+import trueskill
+from trueskill import DELTA, calc_draw_margin
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+# trueskill stops after 10 forward/backward sweeps; a parallel pass moves less per step, and on
+# long chains rounding leaves a noise floor near min_delta, so cap the passes instead
+MAX_ITERATIONS = 20
+
+# largest |mu| or |sigma| difference from the reference library that benchmark-ratings accepts
+TOLERANCE = 1e-6
+
+
+def erfc(x):
+    """ Vectorized form of the approximation trueskill.backends.erfc uses. """
+    z = np.abs(x)
+    t = 1. / (1. + z / 2.)
+    r = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (
+        0.37409196 + t * (0.09678418 + t * (-0.18628806 + t * (
+            0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (
+                -0.82215223 + t * 0.17087277)))))))))
+    return np.where(x < 0, 2. - r, r)
+
+
+def cdf(x):
+    return 0.5 * erfc(-x / math.sqrt(2))
+
+
+def pdf(x):
+    return np.exp(-x ** 2 / 2) / math.sqrt(2 * math.pi)
+
+
+def v_w_win(diff, draw_margin):
+    """ Non-draw V and W truncation corrections for arrays of normalized differences. """
+    x = diff - draw_margin
+    denom = cdf(x)
+    safe = denom > 0
+    v = np.where(safe, pdf(x) / np.where(safe, denom, 1.), -x)
+    w = v * (v + x)
+    if not np.all((w > 0) & (w < 1)):
+        # same limit as trueskill's float backend
+        raise FloatingPointError('Cannot calculate correctly, set backend to "mpmath"')
+    return v, w
+
+
+class FFATrueSkill(object):
+    """ Drop-in for a trueskill.TrueSkill environment's rate() and create_rating(). """
+
+    def __init__(self, env=None):
+        self.env = env or trueskill.global_env()
+
+    def create_rating(self, mu=None, sigma=None):
+        return self.env.create_rating(mu, sigma)
+
+    def supports(self, rating_groups, ranks=None, weights=None):
+        if np is None or weights is not None or callable(self.env.draw_probability):
+            return False
+        if len(rating_groups) < 2 or any(len(group) != 1 for group in rating_groups):
+            return False
+        if ranks is not None and len(set(ranks)) != len(ranks):
+            return False
+        return True
+
+    def rate(self, rating_groups, ranks=None, weights=None, min_delta=DELTA):
+        """ Same contract as trueskill.TrueSkill.rate; groups are ordered best first unless ranks are given. """
+        rating_groups = list(rating_groups)
+
+        if not self.supports(rating_groups, ranks, weights):
+            return self.env.rate(rating_groups, ranks, weights, min_delta)
+
+        order = sorted(range(len(rating_groups)), key=lambda i: ranks[i]) if ranks is not None \
+            else list(range(len(rating_groups)))
+
+        group_keys = [list(rating_groups[i].keys()) if hasattr(rating_groups[i], 'keys') else None for i in order]
+        ratings = [list(rating_groups[i].values())[0] if group_keys[n] else rating_groups[i][0]
+                   for n, i in enumerate(order)]
+
+        mu = np.array([float(r.mu) for r in ratings])
+        sigma = np.array([float(r.sigma) for r in ratings])
+
+        with np.errstate(all='ignore'):
+            new_mu, new_sigma = self.run(mu, sigma, min_delta)
+
+        results = [None] * len(rating_groups)
+        for n, i in enumerate(order):
+            rating = self.env.create_rating(float(new_mu[n]), float(new_sigma[n]))
+            results[i] = {group_keys[n][0]: rating} if group_keys[n] else (rating,)
+
+        return results
+
+    def run(self, mu, sigma, min_delta=DELTA):
+        """ Expectation propagation over a ranking chain of single players, best first.
+
+        Each truncation factor (d_j = p_j - p_j+1 > draw margin) is approximated by a
+        Gaussian site. With the sites fixed, the performances are jointly Gaussian with a
+        tridiagonal precision matrix, so one O(n) pass gives every site its cavity at once
+        and all sites are refreshed together. That reaches the fixed point of the reference's
+        forward/backward sweeps in a handful of passes.
+        """
+        env = self.env
+        beta2 = env.beta ** 2
+        skill_var = sigma ** 2 + env.tau ** 2
+        draw_margin = calc_draw_margin(env.draw_probability, 2, env)
+
+        # performance priors, p_i ~ N(mu_i, sigma_i^2 + tau^2 + beta^2)
+        prior_pi = 1. / (skill_var + beta2)
+        prior_tau = mu * prior_pi
+
+        n = len(mu)
+        site_pi, site_tau = np.zeros(n - 1), np.zeros(n - 1)
+
+        for iteration in range(MAX_ITERATIONS):
+            var, cov_next, mean = self.posterior(prior_pi, prior_tau, site_pi, site_tau)
+
+            diff_var = var[:-1] + var[1:] - 2 * cov_next
+            diff_mean = mean[:-1] - mean[1:]
+
+            # cavity of d_j: its marginal without its own truncation site
+            cav_pi = 1. / diff_var - site_pi
+            cav_tau = diff_mean / diff_var - site_tau
+
+            sqrt_pi = np.sqrt(cav_pi)
+            v, w = v_w_win(cav_tau / sqrt_pi, draw_margin * sqrt_pi)
+            new_pi = cav_pi / (1. - w)
+            new_tau = (cav_tau + sqrt_pi * v) / (1. - w)
+
+            new_site_pi, new_site_tau = new_pi - cav_pi, new_tau - cav_tau
+
+            delta = np.max(np.maximum(np.abs(new_tau - diff_mean / diff_var),
+                                      np.sqrt(np.abs(new_pi - 1. / diff_var))))
+
+            site_pi, site_tau = new_site_pi, new_site_tau
+            if delta <= min_delta:
+                break
+
+        perf_var, cov_next, mean = self.posterior(prior_pi, prior_tau, site_pi, site_tau)
+
+        # what the ranking says about each performance, passed up through the beta noise
+        msg_pi = 1. / perf_var - prior_pi
+        msg_tau = mean / perf_var - prior_tau
+
+        up_var = 1. / msg_pi + beta2
+        post_pi = 1. / skill_var + 1. / up_var
+        post_tau = mu / skill_var + (msg_tau / msg_pi) / up_var
+
+        return post_tau / post_pi, np.sqrt(1. / post_pi)
+
+    @staticmethod
+    def posterior(prior_pi, prior_tau, site_pi, site_tau):
+        """ Variances, covariances with the next performance, and means given the current sites.
+
+        The precision matrix is tridiagonal, so instead of inverting it a forward elimination
+        and a backward pass give just these entries of the covariance, in O(n).
+        """
+        diag = prior_pi.copy()
+        diag[:-1] += site_pi
+        diag[1:] += site_pi
+
+        shift = prior_tau.copy()
+        shift[:-1] += site_tau
+        shift[1:] -= site_tau
+
+        # plain floats: the recurrences are sequential, and NumPy scalars are slower one at a time
+        diag, off, shift = diag.tolist(), (-site_pi).tolist(), shift.tolist()
+        n = len(diag)
+
+        pivot, rhs = [diag[0]] * n, [shift[0]] * n
+        for i in range(1, n):
+            ratio = off[i - 1] / pivot[i - 1]
+            pivot[i] = diag[i] - ratio * off[i - 1]
+            rhs[i] = shift[i] - ratio * rhs[i - 1]
+
+        mean, var, cov_next = [rhs[-1] / pivot[-1]] * n, [1. / pivot[-1]] * n, [0.] * (n - 1)
+        for i in range(n - 2, -1, -1):
+            ratio = off[i] / pivot[i]
+            mean[i] = (rhs[i] - off[i] * mean[i + 1]) / pivot[i]
+            cov_next[i] = -ratio * var[i + 1]
+            var[i] = 1. / pivot[i] + ratio * ratio * var[i + 1]
+
+        return np.array(var), np.array(cov_next), np.array(mean)
+
+
+def timed(rate, groups, repeat):
+    """ Mean seconds per call and the last result, or (None, None) if the backend gives up. """
+    try:
+        start = default_timer()
+        for n in range(repeat):
+            result = rate(groups)
+        return (default_timer() - start) / repeat, result
+    except FloatingPointError:
+        return None, None
+
+
+def benchmark(sizes=(10, 50, 200), repeat=5, env=None):
+    """ Time the reference and NumPy engines on random free-for-all matches.
+
+    Returns (players, reference seconds, numpy seconds, max |mu| difference, max |sigma| difference) per size.
+    Columns are None where a backend's float range gives out on the match.
+    """
+    import random
+
+    env = env or trueskill.global_env()
+    ffa = FFATrueSkill(env)
+    results = []
+
+    for size in sizes:
+        # finish in order of a sampled performance, the way a group's real results fall out
+        ratings = [env.create_rating(random.gauss(env.mu, env.sigma / 2), random.uniform(env.sigma / 4, env.sigma))
+                   for n in range(size)]
+        ratings.sort(key=lambda r: random.gauss(r.mu, math.hypot(r.sigma, env.beta)), reverse=True)
+        groups = [(r,) for r in ratings]
+
+        reference_time, reference = timed(env.rate, groups, repeat)
+        fast_time, fast = timed(ffa.rate, groups, repeat)
+
+        mu_diff = sigma_diff = None
+        if reference is not None and fast is not None:
+            mu_diff = max(abs(r[0].mu - f[0].mu) for r, f in zip(reference, fast))
+            sigma_diff = max(abs(r[0].sigma - f[0].sigma) for r, f in zip(reference, fast))
+
+        results.append((size, reference_time, fast_time, mu_diff, sigma_diff))
+
+    return results
@@ -2,26 +2,23 @@ from datetime import datetime, timedelta
 from flask import current_app
 from flask_wtf import Form
 
-import requests
 from wtforms import HiddenField, StringField, IntegerField, BooleanField, \
     SelectField, SelectMultipleField, TextAreaField, SubmitField, DateTimeField, validators
 
 
 from .models import db, get_count, User, Group, Challenge
+from .gifs import gifs
 
 
 def validate_url(self, field):
-    try:
-        r = requests.get(field.data)
-    except:
-        raise validators.ValidationError('URL is unreachable.')
-    
-    if r.status_code != 200:
-        raise validators.ValidationError('URL is unreachable.')
-    
-    if 'gif' not in r.headers['content-type']:
-        raise validators.ValidationError('URL is not a gif.')
-    
+    if not field.data:
+        return  # DataRequired reports it, no request needed
+
+    # kept on the field so the view can store the metadata without fetching again
+    field.gif = gifs.inspect(field.data)
+    if field.gif.error:
+        raise validators.ValidationError(field.gif.error)
+
 def number_range(min, max):
     
     def _range(form, field):
@@ -59,7 +56,11 @@ class ChallengeForm(Form):
 class ChallengeEntry(Form):
     url = StringField('URL', validators=[validate_url, validators.DataRequired('Please Enter a value')])
     prompt_id = HiddenField()
-    entry_id = HiddenField()
+
+class NotificationsForm(Form):
+    notifications = SelectField('Challenge mail', choices=[('immediate', 'As it happens'),
+                                                           ('hourly', 'Hourly digest'),
+                                                           ('daily', 'Daily digest')])
 
 class TournamentForm(Form):
     name = StringField('Name', [validators.Length(min=1, max=30, message="Length: 1-30 characters")])
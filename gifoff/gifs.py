@@ -0,0 +1,220 @@
+"""Checking that an entry URL points at a reachable GIF, and reading its metadata.
+
+GifValidator keeps one pooled requests.Session for the app, bounds every check with
+connect/read timeouts and a GIF_CHECK_DEADLINE for the whole body, and reads at most
+GIF_CHECK_BYTES of it: a ranged, streamed GET whose connection is dropped once that
+prefix is in. The prefix gives the GIF's
+signature, dimensions and the frames that start within it; the byte size comes from the
+response headers. Results are kept for a while so re-submitting or re-validating the
+same URL costs nothing.
+"""
+import socket
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+from time import time, monotonic
+
+import requests
+from requests.adapters import HTTPAdapter
+
+GIF_SIGNATURES = (b'GIF87a', b'GIF89a')
+
+UNREACHABLE = 'URL is unreachable.'
+NOT_A_GIF = 'URL is not a gif.'
+
+# error is None for a GIF; frames only counts frames starting within the bytes read, so
+# it is a lower bound for long GIFs. size is None when the server doesn't say.
+GifInfo = namedtuple('GifInfo', ['error', 'width', 'height', 'frames', 'size'])
+
+
+def skip_sub_blocks(data, pos):
+    """ Position after the data sub-blocks starting at `pos`, None if they run past the end of `data`. """
+    while pos < len(data):
+        size = data[pos]
+        pos += 1 + size
+        if size == 0:
+            return pos
+
+    return None
+
+
+def color_table(packed):
+    """ Bytes in the color table a descriptor's packed field announces. """
+    return 3 << ((packed & 0x07) + 1) if packed & 0x80 else 0
+
+
+def images(data):
+    """ (start, end) of each image block in a GIF's bytearray; end is None for one cut off by the end of `data`. """
+    pos = 13 + color_table(data[10])
+
+    while pos is not None and pos < len(data):
+        block = data[pos]
+
+        if block == 0x2C:  # image descriptor, local color table, LZW code size byte, sub-blocks
+            end = None
+            if pos + 10 <= len(data):
+                end = skip_sub_blocks(data, pos + 10 + color_table(data[pos + 9]) + 1)
+            yield pos, end
+            pos = end
+        elif block == 0x21:  # extension: label byte, then sub-blocks
+            pos = skip_sub_blocks(data, pos + 2)
+        else:  # trailer
+            return
+
+
+def is_gif(data):
+    return len(data) >= 13 and bytes(data[:6]) in GIF_SIGNATURES
+
+
+def parse(data):
+    """ (width, height, frames) from the start of a GIF, or None if it isn't one. """
+    data = bytearray(data)
+    if not is_gif(data):
+        return None
+
+    width, height = struct.unpack('<HH', bytes(data[6:10]))
+
+    return width, height, sum(1 for _ in images(data))
+
+
+def first_frame(data):
+    """ A GIF cut after its first image: a still of the first frame, None if there isn't a whole one. """
+    data = bytearray(data)
+    if not is_gif(data):
+        return None
+
+    for start, end in images(data):
+        return bytes(data[:end]) + b'\x3b' if end else None
+
+    return None
+
+
+def content_size(response, read):
+    """ Full size of the resource in bytes from a 200/206 response, None if unknown. """
+    if response.status_code == 206:
+        total = response.headers.get('content-range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+
+    length = response.headers.get('content-length', '')
+    return int(length) if length.isdigit() else read
+
+
+def cut(response):
+    """ Shut down a streamed response's socket, which ends a read blocked on it. """
+    sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class GifValidator(object):
+
+    def __init__(self, app=None):
+        self.session = None
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('GIF_CHECK_TIMEOUT', (3.05, 5))
+        app.config.setdefault('GIF_CHECK_DEADLINE', 10)
+        app.config.setdefault('GIF_CHECK_TTL', 60*60)
+        app.config.setdefault('GIF_CHECK_FAILURE_TTL', 60)
+        app.config.setdefault('GIF_CHECK_CACHE_SIZE', 2048)
+        app.config.setdefault('GIF_CHECK_POOL_SIZE', 10)
+        app.config.setdefault('GIF_CHECK_BYTES', 64*1024)
+
+        self.timeout = tuple(app.config['GIF_CHECK_TIMEOUT'])
+        self.deadline = app.config['GIF_CHECK_DEADLINE']
+        self.ttl = app.config['GIF_CHECK_TTL']
+        self.failure_ttl = app.config['GIF_CHECK_FAILURE_TTL']
+        self.cache_size = app.config['GIF_CHECK_CACHE_SIZE']
+        self.max_bytes = app.config['GIF_CHECK_BYTES']
+
+        adapter = HTTPAdapter(pool_connections=app.config['GIF_CHECK_POOL_SIZE'],
+                              pool_maxsize=app.config['GIF_CHECK_POOL_SIZE'])
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # some hosts serve video for a .gif URL unless the client asks for a GIF
+        self.session.headers.update({'Accept': 'image/gif', 'Range': 'bytes=0-{}'.format(self.max_bytes - 1)})
+
+        app.extensions['gifs'] = self
+
+    def check(self, url):
+        """ None if `url` serves a GIF, otherwise the validation message. """
+        return self.inspect(url).error
+
+    def inspect(self, url):
+        """ GifInfo for `url`, from the result cache when it's fresh. """
+        now = time()
+
+        with self.lock:
+            cached = self.results.get(url)
+            if cached and cached[0] > now:
+                return cached[1]
+
+        info = self.fetch(url)
+
+        with self.lock:
+            self.results.pop(url, None)
+            self.results[url] = (now + (self.failure_ttl if info.error else self.ttl), info)
+            while len(self.results) > self.cache_size:
+                self.results.popitem(last=False)
+
+        return info
+
+    def fetch(self, url):
+        deadline = monotonic() + self.deadline
+
+        try:
+            response = self.session.get(url, stream=True, timeout=self.timeout)
+        except (requests.RequestException, ValueError):
+            return GifInfo(UNREACHABLE, None, None, None, None)
+
+        # the read timeout restarts with every byte, so a host trickling the body could hold
+        # the check for GIF_CHECK_BYTES reads; at the deadline the socket is cut mid-read
+        watchdog = threading.Timer(max(0, deadline - monotonic()), cut, [response])
+        watchdog.daemon = True
+        watchdog.start()
+
+        try:
+            if response.status_code not in (200, 206):
+                return GifInfo(UNREACHABLE, None, None, None, None)
+
+            head = bytearray()
+            try:
+                for chunk in response.iter_content(chunk_size=16*1024):
+                    head.extend(chunk)
+                    if len(head) >= self.max_bytes or monotonic() >= deadline:
+                        break
+            except (requests.RequestException, OSError):
+                return GifInfo(UNREACHABLE, None, None, None, None)
+
+            if monotonic() >= deadline:
+                return GifInfo(UNREACHABLE, None, None, None, None)
+
+            head = bytes(head[:self.max_bytes])
+            size = content_size(response, len(head) if len(head) < self.max_bytes else None)
+
+            meta = parse(head)
+            if meta:
+                return GifInfo(None, meta[0], meta[1], meta[2], size)
+
+            # a signature with a cut-off header, or a HEAD-like empty body from a gif URL
+            if head[:6] in GIF_SIGNATURES or not head and 'gif' in response.headers.get('content-type', ''):
+                return GifInfo(None, None, None, None, size)
+
+            return GifInfo(NOT_A_GIF, None, None, None, size)
+        finally:
+            watchdog.cancel()
+            # drops the connection instead of draining the rest of the GIF back into the pool
+            response.close()
+
+
+gifs = GifValidator()
@@ -0,0 +1,177 @@
+"""Local copies of entry GIFs, with a still poster of each one's first frame.
+
+An entry's GIF is fetched once, off the request, after its url is saved. It is stored
+under GIF_STORE_DIR by the sha256 of its bytes, so a GIF entered twice is stored once,
+and the digest is written to Entry.digest. The poster is the GIF cut after its first
+image (gifs.first_frame), so nothing is decoded. main.stored_gif serves both with
+send_file and far-future cache headers; pages show the poster and swap in the animation
+when it's clicked (static/js/app.js). Entries without a digest hotlink their url as before.
+"""
+import hashlib
+import os
+import tempfile
+
+import requests
+
+from .gifs import gifs, is_gif, first_frame
+from .models import db, db_commit, Entry
+from .tasks import TaskQueue
+
+KINDS = ('animated', 'poster')
+
+
+class GifStore(object):
+
+    def __init__(self, app=None):
+        self.root = None
+        self.tasks = TaskQueue('gifstore', prefix='GIF_STORE', size=200)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('GIF_STORE_DIR', os.path.join(app.instance_path, 'gifs'))
+        app.config.setdefault('GIF_STORE_MAX_BYTES', 20*1024*1024)
+        app.config.setdefault('GIF_STORE_CACHE_TIMEOUT', 60*60*24*365)
+
+        self.root = app.config['GIF_STORE_DIR']
+        self.max_bytes = app.config['GIF_STORE_MAX_BYTES']
+
+        self.tasks.init_app(app)
+
+        app.extensions['gifstore'] = self
+
+    def submit(self, entry_id, url):
+        """ Store an entry's GIF off the request. When the queue is full the entry keeps hotlinking
+            its url until `flask store-gifs` picks it up. """
+        return self.tasks.submit(store_entry, entry_id, url)
+
+    def path(self, digest, kind='animated'):
+        """ Where a stored GIF or its poster lives, None for anything that isn't a sha256 hex digest. """
+        if kind not in KINDS or len(digest) != 64 or digest.strip('0123456789abcdef'):
+            return None
+
+        name = '{}.gif'.format(digest) if kind == 'animated' else '{}.poster.gif'.format(digest)
+        return os.path.join(self.root, digest[:2], name)
+
+    def has(self, digest):
+        return digest is not None and os.path.exists(self.path(digest)) and os.path.exists(self.path(digest, 'poster'))
+
+    def write(self, path, source):
+        """ Move the temp file `source` to `path` unless it's already there; renames are atomic. """
+        if os.path.exists(path):
+            os.remove(source)
+            return
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+        os.rename(source, path)
+
+    def download(self, response, out):
+        """ Copy a GIF response body to `out`, (sha256, poster) or None if it isn't a GIF, is too big
+            or has no whole first frame. Only the bytes up to the first frame are kept for the poster. """
+        if response.status_code != 200:
+            return None
+
+        sha = hashlib.sha256()
+        read = 0
+        head, poster, parse_at, sniffed = bytearray(), None, 64*1024, False
+
+        try:
+            for chunk in response.iter_content(chunk_size=64*1024):
+                read += len(chunk)
+                if read > self.max_bytes:
+                    return None
+
+                sha.update(chunk)
+                out.write(chunk)
+
+                if poster is None:
+                    head.extend(chunk)
+                    # chunks can be shorter than the 13 byte header, so check it once it's all here
+                    if not sniffed and len(head) >= 13:
+                        if not is_gif(head):
+                            return None
+                        sniffed = True
+
+                    # parse again only each time the prefix doubles, not per chunk
+                    if len(head) >= parse_at:
+                        poster = first_frame(head)
+                        parse_at = len(head) * 2
+        except requests.RequestException:
+            return None
+
+        if not sniffed:
+            return None
+
+        if poster is None:
+            poster = first_frame(head)
+
+        return (sha, poster) if poster else None
+
+    def fetch(self, url):
+        """ Download a GIF into the store, the digest of its content or None. """
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            pass
+
+        try:
+            # the validator's pooled session, without its Range header
+            response = gifs.session.get(url, stream=True, timeout=gifs.timeout, headers={'Range': None})
+        except (requests.RequestException, ValueError):
+            return None
+
+        temps = []
+        try:
+            handle, source = tempfile.mkstemp(dir=self.root, suffix='.part')
+            temps.append(source)
+            with os.fdopen(handle, 'wb') as out:
+                downloaded = self.download(response, out)
+
+            if downloaded is None:
+                return None
+
+            sha, poster = downloaded
+            digest = sha.hexdigest()
+
+            handle, poster_source = tempfile.mkstemp(dir=self.root, suffix='.part')
+            temps.append(poster_source)
+            with os.fdopen(handle, 'wb') as out:
+                out.write(poster)
+
+            self.write(self.path(digest, 'poster'), poster_source)
+            self.write(self.path(digest), source)
+            temps = []
+
+            return digest
+        finally:
+            response.close()
+            # whatever went wrong, don't leave .part files behind
+            for temp in temps:
+                if os.path.exists(temp):
+                    os.remove(temp)
+
+
+gifstore = GifStore()
+
+
+def store_entry(entry_id, url):
+    """ Point an entry at a stored copy of `url`, fetching it unless another entry already has. Caller is off the request. """
+    digest = db.session.query(Entry.digest).filter(Entry.url==url, Entry.digest!=None).limit(1).scalar()
+
+    if not gifstore.has(digest):
+        digest = gifstore.fetch(url)
+        if digest is None:
+            return None
+
+    # the player may have saved a different url while this one downloaded
+    entry = Entry.query.filter(Entry.id==entry_id, Entry.url==url).first()
+    if entry is None:
+        return None
+
+    entry.digest = digest
+    return digest if db_commit() else None
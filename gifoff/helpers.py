@@ -1,10 +1,15 @@
 from functools import wraps
+from hashlib import sha1
 
-from flask import abort, flash
+from flask import abort, flash, request, session, make_response
 from flask_security import current_user
 
+from .memo import now
 from .models import db
 
+# rendered pages show relative times ("ends in 2 hours"), so a validator is only good this long
+CONDITIONAL_WINDOW = 60
+
 def access_required(func):
     """ This decorator ensures that the current user is logged in before calling the actual view.
         Calls the unauthorized_view_function() when the user is not logged in."""
@@ -39,6 +44,50 @@ def admin_required(func):
     return decorated_view
 
 
+def conditional(validator):
+    """ Answer a GET with 304 Not Modified, before the view runs, when nothing it renders has changed.
+
+    `validator` takes the view's arguments and returns (parts, last_modified): anything that
+    changes when the page would, e.g. cache generations, and the newest date_modified behind it.
+    The ETag also covers the viewer, their groups (the nav bar) and a CONDITIONAL_WINDOW time
+    slot. Only If-None-Match is trusted; deletes leave no date_modified behind, so
+    Last-Modified is informational.
+    """
+    def decorator(func):
+        @wraps(func)
+        def decorated_view(*args, **kwargs):
+            # pending flashes are rendered (and consumed) by the page
+            if request.method != 'GET' or session.get('_flashes'):
+                return func(*args, **kwargs)
+
+            parts, last_modified = validator(**kwargs)
+
+            viewer = (current_user.get_id(), sorted(g.id for g in current_user.player_of)) \
+                if current_user.is_authenticated else None
+            slot = now().timestamp // CONDITIONAL_WINDOW
+
+            etag = sha1(repr((request.path, viewer, slot, parts)).encode('utf-8')).hexdigest()
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+
+            return response
+
+        return decorated_view
+
+    return decorator
+
+
 class Bracket:
     def __init__(self, players):
         self.players = players
@@ -0,0 +1,74 @@
+"""Cache invalidation driven by the ORM session.
+
+Every cached fragment and query result for a group or challenge is keyed by that
+group's or challenge's generation (see cache.py). after_flush maps each changed row
+to the generations it affects, and after_commit bumps them, so nothing is dropped
+for a transaction that rolls back.
+
+Bulk statements (Query.update/delete, bulk_insert_mappings) skip the flush, so what
+they touch is marked with stale() and bumped by the same after_commit, e.g. in
+ratings.write_replay.
+"""
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+from .cache import bump
+from .models import db, Group, Challenge, Prompt, Entry, FFARating, GroupPlayerStats, GroupPlayers, GroupAuthors
+
+PENDING = '_invalidate'
+
+
+def affected(obj):
+    """ (kind, id) generations a changed row makes stale. """
+    if isinstance(obj, Entry):
+        challenge_id = obj.challenge_id or (obj.prompt.challenge_id if obj.prompt else None)
+        return [('challenge', challenge_id)]
+
+    if isinstance(obj, Prompt):
+        return [('challenge', obj.challenge_id)]
+
+    if isinstance(obj, Challenge):
+        return [('challenge', obj.id), ('group', obj.group_id)]
+
+    if isinstance(obj, (FFARating, GroupPlayerStats, GroupPlayers, GroupAuthors)):
+        return [('group', obj.group_id)]
+
+    # players/authors collections live on the group
+    if isinstance(obj, Group):
+        return [('group', obj.id)]
+
+    return []
+
+
+def stale(kind, id, session=None):
+    """ Have a generation bumped when the session commits, for rows a bulk statement changed. """
+    (session or db.session).info.setdefault(PENDING, set()).add((kind, id))
+
+
+def after_flush(session, flush_context):
+    pending = session.info.setdefault(PENDING, set())
+
+    changed = list(session.new) + list(session.deleted) + \
+              [obj for obj in session.dirty if session.is_modified(obj)]
+
+    for obj in changed:
+        pending.update((kind, id) for kind, id in affected(obj) if id is not None)
+
+
+def after_commit(session):
+    for kind, id in session.info.pop(PENDING, set()):
+        bump(kind, id)
+
+
+def after_rollback(session):
+    session.info.pop(PENDING, None)
+
+
+def register(session=SignallingSession):
+    """ Listen on a session class, Flask-SQLAlchemy's by default. """
+    if event.contains(session, 'after_commit', after_commit):
+        return
+
+    event.listen(session, 'after_flush', after_flush)
+    event.listen(session, 'after_commit', after_commit)
+    event.listen(session, 'after_rollback', after_rollback)
@@ -0,0 +1,117 @@
+"""Moving challenges through upcoming, active and pending as their times pass.
+
+Challenge.status is written with the challenge (models.set_challenge_status), but time
+passing is no write, so tick() moves on every open challenge whose start or end time has
+come, and adds a judge reminder to the outbox for each one that became pending. Each
+move is a guarded UPDATE, so when several processes tick at once only one of them moves
+a challenge and sends its reminder. `flask tick` runs it from cron; with CHALLENGE_AUTOTICK
+a scheduler thread in the web process runs it at the next start or end time, and at
+least every CHALLENGE_TICK_INTERVAL seconds.
+"""
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .cache import bump
+from .models import db, db_commit, Challenge
+from .outbox import notify, drainer
+from .tasks import KickedWorker
+
+
+def due(now):
+    """ Filter for open challenges whose status their times have moved on from. """
+    return or_(and_(Challenge.status=='upcoming', Challenge.utc_start_time<=now),
+               and_(Challenge.status=='active', Challenge.utc_end_time<=now))
+
+
+def due_challenges(now):
+    return Challenge.query.filter(due(now)).order_by(Challenge.id)
+
+
+def tick(now=None):
+    """ Bring every due challenge's status up to date, the (challenge, old status) pairs this call moved. """
+    now = now or datetime.utcnow()
+    moved = []
+
+    for challenge in due_challenges(now):
+        old, new = challenge.status, challenge.current_status(now)
+        if new == old:
+            continue
+
+        won = Challenge.query.filter(Challenge.id==challenge.id, Challenge.status==old)\
+                             .update({Challenge.status: new}, synchronize_session=False)
+        if not won:
+            continue  # another process moved it first
+
+        set_committed_value(challenge, 'status', new)
+
+        if new == 'pending' and current_app.config['CHALLENGE_JUDGE_REMINDERS']:
+            notify('judge_reminder', challenge)
+
+        moved.append((challenge, old))
+
+    if not moved or not db_commit():
+        return []
+
+    # guarded UPDATEs skip the session's invalidation, and the pages show the status
+    for challenge, old in moved:
+        bump('challenge', challenge.id)
+        bump('group', challenge.group_id)
+
+    return moved
+
+
+def next_change(now=None):
+    """ The soonest start or end time still to come for an open challenge, None if there isn't one. """
+    now = now or datetime.utcnow()
+
+    starts = db.session.query(func.min(Challenge.utc_start_time))\
+                       .filter(Challenge.status=='upcoming', Challenge.utc_start_time>now).scalar()
+    ends = db.session.query(func.min(Challenge.utc_end_time))\
+                     .filter(Challenge.status.in_(('upcoming', 'active')), Challenge.utc_end_time>now).scalar()
+
+    return min(filter(None, [starts, ends])) if starts or ends else None
+
+
+class ChallengeScheduler(KickedWorker):
+    """ One thread per process that ticks at the next start or end time, or when kicked after a challenge is saved. """
+
+    name = 'lifecycle'
+
+    def init_app(self, app):
+        app.config.setdefault('CHALLENGE_AUTOTICK', True)
+        app.config.setdefault('CHALLENGE_TICK_INTERVAL', 60)
+        app.config.setdefault('CHALLENGE_JUDGE_REMINDERS', True)
+
+        app.extensions['challenge_scheduler'] = self
+        super(ChallengeScheduler, self).init_app(app)
+
+    def enabled(self):
+        """ Kicks are no-ops unless CHALLENGE_AUTOTICK. """
+        return self.app.config['CHALLENGE_AUTOTICK']
+
+    def interval(self):
+        return self.app.config['CHALLENGE_TICK_INTERVAL']
+
+    def run(self):
+        if tick():
+            drainer.kick()  # judge reminders
+
+        return self.wait()
+
+    def wait(self):
+        """ Seconds until the next start or end time, at most CHALLENGE_TICK_INTERVAL. """
+        interval = self.interval()
+
+        now = datetime.utcnow()
+        upcoming = next_change(now)
+        if upcoming is None:
+            return interval
+
+        # a moment past the boundary, so the challenge is due when tick() looks
+        return max(0, min(interval, (upcoming - now).total_seconds() + 0.5))
+
+
+scheduler = ChallengeScheduler()
@@ -1,14 +1,217 @@
+"""Outgoing mail.
+
+send_async_email() hands a message to the dispatcher: a bounded queue drained by
+MAIL_WORKERS daemon threads. Each worker takes whatever is queued, up to MAIL_BATCH_SIZE
+messages, and sends it over one SMTP session. A batch that fails is retried on a new
+session after MAIL_RETRY_BACKOFF, doubling each time, for up to MAIL_RETRIES attempts;
+only the messages not yet sent are retried. A message the server refuses with a 5xx reply
+is given up on; one refused with a 4xx is only refused for now, and is retried with the
+unsent rest once the batch has been through. Workers start with the first message in each
+process, and the queue is flushed at exit for up to MAIL_SHUTDOWN_TIMEOUT seconds.
+"""
+import atexit
+import os
+import smtplib
+import socket
 import threading
-from flask import copy_current_request_context, current_app
-from flask_mail import Mail
+from time import sleep, time
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+from flask_mail import Mail, BadHeaderError
 
 mail = Mail()
 
-def send_async_email(msg):
+# errors about one message rather than the session; rejected() tells which are final
+REFUSED = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError, BadHeaderError)
+
+
+def rejected(error):
+    """ True if the server will never take the message: a 5xx reply, or a header we can't send.
+
+    A 4xx reply (mailbox busy, greylisting, over quota) is worth another try.
+    """
+    if isinstance(error, BadHeaderError):
+        return True
+
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        # every recipient was refused, each with its own code
+        codes = [code for code, response in error.recipients.values()]
+    else:
+        codes = [getattr(error, 'smtp_code', None)]
+
+    return bool(codes) and all(isinstance(code, int) and 500 <= code < 600 for code in codes)
+
+
+class MailDispatcher(object):
+
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = None
+        self.workers = []
+        self.pid = None
+        self.lock = threading.Lock()
+        self.counts = dict(sent=0, failed=0, retried=0, dropped=0)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_WORKERS', 2)
+        app.config.setdefault('MAIL_QUEUE_SIZE', 500)
+        app.config.setdefault('MAIL_QUEUE_TIMEOUT', 1.0)
+        app.config.setdefault('MAIL_BATCH_SIZE', 20)
+        app.config.setdefault('MAIL_RETRIES', 3)
+        app.config.setdefault('MAIL_RETRY_BACKOFF', 2.0)
+        app.config.setdefault('MAIL_SHUTDOWN_TIMEOUT', 10.0)
+
+        self.app = app
+        self.queue = Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+
+        app.extensions['mail_dispatcher'] = self
+        atexit.register(self.flush)
+
+    @property
+    def depth(self):
+        """ Messages waiting for a worker in this process. """
+        return self.queue.qsize()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, depth=self.depth, workers=len(self.workers))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def start(self):
+        """ Start the workers, again in a process forked after they were started. """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            if self.pid is not None:
+                # forked: the parent's queued messages and threads aren't ours to send or join
+                self.queue = Queue(maxsize=self.app.config['MAIL_QUEUE_SIZE'])
+
+            self.pid = os.getpid()
+            self.workers = [threading.Thread(name='mail-{}'.format(n), target=self.work)
+                            for n in range(self.app.config['MAIL_WORKERS'])]
+            for worker in self.workers:
+                worker.daemon = True
+                worker.start()
 
-    @copy_current_request_context
-    def send_message(message):
-        mail.send(message)
+    def submit(self, msg):
+        """ Queue a message, False if the queue stayed full for MAIL_QUEUE_TIMEOUT. """
+        self.start()
 
-    sender = threading.Thread(name='mail_sender', target=send_message, args=(msg,))
-    sender.start()
\ No newline at end of file
+        try:
+            self.queue.put(msg, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except Full:
+            self.count('dropped')
+            self.app.logger.error('Mail queue full, dropped "{}" to {}'.format(msg.subject, msg.send_to))
+            return False
+
+        return True
+
+    def take(self):
+        """ The next batch: blocks for one message, then takes what else is already queued. """
+        batch = [self.queue.get()]
+
+        while len(batch) < self.app.config['MAIL_BATCH_SIZE']:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+
+        return batch
+
+    def work(self):
+        while True:
+            batch = self.take()
+            try:
+                with self.app.app_context():
+                    self.send_batch(batch)
+            except Exception:
+                self.app.logger.exception('Mail worker failed on a batch of {}'.format(len(batch)))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def send_batch(self, batch, retries=None):
+        """ Send messages over one SMTP session, retrying the unsent rest on a new one.
+
+        Returns (message, error) for each message that didn't go out. `retries` defaults to
+        MAIL_RETRIES.
+        """
+        pending = list(batch)
+        failures = []
+        if not pending:
+            return failures
+
+        backoff = self.app.config['MAIL_RETRY_BACKOFF']
+        if retries is None:
+            retries = self.app.config['MAIL_RETRIES']
+
+        error = None
+        for attempt in range(retries + 1):
+            if attempt:
+                self.count('retried', len(pending))
+                sleep(backoff * 2 ** (attempt - 1))
+
+            deferred = []
+            try:
+                with mail.connect() as conn:
+                    while pending:
+                        try:
+                            conn.send(pending[0])
+                            self.count('sent')
+                        except REFUSED as e:
+                            if rejected(e):
+                                self.count('failed')
+                                self.app.logger.error('Mail "{}" rejected: {}'.format(pending[0].subject, e))
+                                failures.append((pending[0], e))
+                            else:
+                                # refused for now, the rest of the batch goes on and it waits for the next attempt
+                                deferred.append(pending[0])
+                                error = e
+                        pending.pop(0)
+            except (smtplib.SMTPException, socket.error) as e:
+                # with nothing left, everything was tried and only closing the session failed
+                if pending:
+                    error = e
+
+            pending = deferred + pending
+            if not pending:
+                return failures
+            self.app.logger.warning('Mail batch attempt {} failed, {} unsent: {}'.format(attempt + 1, len(pending), error))
+
+        self.count('failed', len(pending))
+        for msg in pending:
+            self.app.logger.error('Mail "{}" to {} not sent after {} attempts'.format(msg.subject, msg.send_to, retries + 1))
+
+        return failures + [(msg, error) for msg in pending]
+
+    def flush(self, timeout=None):
+        """ Wait for queued mail to go out, True if the queue emptied within `timeout`. """
+        if self.pid != os.getpid():
+            return True
+
+        if timeout is None:
+            timeout = self.app.config['MAIL_SHUTDOWN_TIMEOUT']
+
+        deadline = time() + timeout
+        while self.queue.unfinished_tasks and time() < deadline:
+            sleep(0.05)
+
+        return not self.queue.unfinished_tasks
+
+
+dispatcher = MailDispatcher()
+
+
+def send_async_email(msg):
+    return dispatcher.submit(msg)
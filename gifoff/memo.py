@@ -0,0 +1,61 @@
+"""Request-scoped memoization.
+
+Values live on flask.g, so they last for one app context: a request, or one CLI
+command (call clear() between units of work in long-running commands). Outside an
+app context nothing is remembered.
+"""
+from functools import wraps
+
+import arrow
+from flask import g, has_app_context
+
+
+def store(name):
+    """ A dict for `name` that lives as long as the current app context. """
+    if not has_app_context():
+        return dict()
+
+    return g.__dict__.setdefault('_memo_{}'.format(name), dict())
+
+
+def clear():
+    if has_app_context():
+        for name in [name for name in g.__dict__ if name.startswith('_memo_')]:
+            del g.__dict__[name]
+
+
+def now():
+    """ arrow.utcnow(), pinned for the rest of the request so every row agrees on the time. """
+    pinned = store('now')
+    if 'now' not in pinned:
+        pinned['now'] = arrow.utcnow()
+
+    return pinned['now']
+
+
+def memoized(*depends):
+    """ Remember a method's result per instance and arguments for the request.
+
+    `depends` names instance attributes the result is derived from; the stored value
+    is recomputed if any of them changes during the request. Used under
+    hybrid_property/hybrid_method, class-level (expression) access is not memoized.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(self, *args):
+            if isinstance(self, type):
+                return fn(self, *args)
+
+            results = store(fn.__name__)
+            key = (id(self),) + args
+            state = tuple(getattr(self, name) for name in depends)
+
+            # the instance is kept in the entry so its id can't be reused within the request
+            if key not in results or results[key][1] != state:
+                results[key] = (self, state, fn(self, *args))
+
+            return results[key][2]
+
+        return wrapper
+
+    return decorator
@@ -1,20 +1,28 @@
 from datetime import datetime, timedelta
 from random import randint
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, namedtuple, OrderedDict
 
 import arrow
 import trueskill
 import json
 
+from flask import current_app
 from flask_security import UserMixin, RoleMixin
 from flask_sqlalchemy import SQLAlchemy
 
-from sqlalchemy import func, select, desc, and_
-from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy import event, func, select, desc, and_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
+from sqlalchemy.orm import joinedload
+
+from .cache import generation, fetch
+from .memo import memoized, now
 
 db = SQLAlchemy()
 
+# Challenge.status values of a challenge still without a winner
+OPEN = ('upcoming', 'active', 'pending')
+
 def db_commit():
     try:
         db.session.commit()
@@ -25,9 +33,12 @@ def db_commit():
         db.session.flush()
         return False
 
+def count_query(model, **filters):
+    return db.session.query(func.count(model.id)).filter_by(**filters)
+
 def get_count(model, **filters):
     # return q.with_entities([func.count()]).order_by(None).scalar()
-    return db.session.query(func.count(model.id)).filter_by(**filters).scalar() or 0
+    return count_query(model, **filters).scalar() or 0
 
 def q_count(q):
     return q.count() or 0
@@ -60,6 +71,8 @@ class Base(db.Model):
 
 class User(Base, UserMixin):
     __tablename__ = "user"
+    __table_args__ = (db.Index('ix_user_notifications_digest_sent_at', 'notifications', 'digest_sent_at'),
+                      db.Index('ix_user_digest_claim', 'digest_claim'))
     # User authentication information
     username = db.Column(db.String(250), nullable=True, unique=False)
     password = db.Column(db.String(250), nullable=False, server_default='')
@@ -75,52 +88,67 @@ class User(Base, UserMixin):
     
     player_of = db.relationship('Group', secondary='group_players')
     author_of = db.relationship('Group', secondary='group_authors')
+    
+    # notification mail (gifoff/outbox.py): 'immediate', or coalesced into an 'hourly' or 'daily' digest
+    notifications = db.Column(db.String(10), nullable=False, default='immediate', server_default='immediate')
+    # when the last digest went out and the last outbox row it covered; claim marks a digest being sent
+    digest_sent_at = db.Column(db.DateTime())
+    digest_outbox_id = db.Column(db.Integer(), nullable=False, default=0, server_default='0')
+    digest_claim = db.Column(db.String(32))
+    # failed sends of the digest due now, reset once it goes out or is given up on
+    digest_attempts = db.Column(db.Integer(), nullable=False, default=0, server_default='0')
+    # after a switch back to 'immediate', the switch time: rows sent before it are owed in a final digest
+    digest_until = db.Column(db.DateTime())
+        
+    @hybrid_method
+    def group_stats(self, group):
+        stats = GroupPlayerStats.rows(group.id, [self.id]).first()
+        if stats:
+            return stats
+        
+        # no row yet: counts start at zero, the rating carries on from rating history
+        stats = GroupPlayerStats(group_id=group.id, player_id=self.id, entries=0, total_score=0, wins=0)
+        rating = GroupPlayerStats.history_ratings(group.id, [self.id]).get(self.id)
+        if rating:
+            stats.rating = rating
+        return stats
         
     @hybrid_method
     def group_entries(self, group):  
-        return db.session.query(func.count(Entry.id)).filter(Entry.player_id==self.id).filter(Entry.prompt_id.in_(group.prompts)).scalar() or 0
+        return self.group_stats(group).entries
     
     @hybrid_method
     def group_score(self, group):  
-        this = db.session.query(func.sum(Entry.score)).filter(Entry.player_id==self.id).filter(Entry.prompt_id.in_(group.prompts))
-        return round(this.scalar() or 0, 1)
+        return round(self.group_stats(group).total_score, 1)
     
     @group_score.expression
     def group_score(self, group):
-        return select([func.sum(Entry.score)]).where(Entry.player_id==self.id).where(Entry.prompt_id.in_(group.prompts))
+        return select([GroupPlayerStats.total_score]).where(GroupPlayerStats.player_id==self.id).where(GroupPlayerStats.group_id==group.id)
     
     @hybrid_method
     def group_wins(self, group):
-        return q_count(db.session.query(Challenge).filter(Challenge.winner_id==self.id, Challenge.group_id==group.id))
+        return self.group_stats(group).wins
     
     @group_wins.expression
     def group_wins(self, group):
-        return select([func.count(Challenge.winner_id)]).where(Challenge.winner_id==self.id).where(Challenge.group_id==group.id)
+        return select([GroupPlayerStats.wins]).where(GroupPlayerStats.player_id==self.id).where(GroupPlayerStats.group_id==group.id)
     
     @hybrid_method
     def group_avg_score(self, group):
-        return round(self.group_score(group)/(self.group_entries(group) or 1), 1)
+        return self.group_stats(group).avg_score
     
     @hybrid_method
     def group_rating(self, group, challenge=None):
-        rate_obj = db.session.query(FFARating)\
-                             .filter(FFARating.player==self, FFARating.group==group)\
-                             .order_by(FFARating.id.desc()).first()
-        if rate_obj:
-            return rate_obj.rating
-        else:
-            rate_obj = FFARating(player=self, group=group, challenge=challenge)
-            rate_obj.rating = trueskill.Rating()
-            if db_commit():
-                return rate_obj.rating
-            else:
-                return False
+        return self.group_stats(group).rating or trueskill.Rating()
     
     @hybrid_method
     def update_group_rating(self, challenge, rating):
         rate_obj = FFARating(player=self, group=challenge.group, challenge=challenge)
         rate_obj.rating = rating
         
+        stats = GroupPlayerStats.for_players(challenge.group.id, [self.id])[self.id]
+        stats.rating = rating
+        
         if db_commit():
             return rate_obj
         else:
@@ -143,13 +171,19 @@ class Group(Base):
     authors = db.relationship('User', secondary='group_authors')
     
     @hybrid_property
+    @memoized()
     def prompts(self):
         return [p.id for c in self.challenges for p in c.prompts if c.complete==True]
     
+    @classmethod
+    def challenge_count(cls, group_id, statuses):
+        return db.session.query(func.count(Challenge.id))\
+                         .filter(Challenge.group_id==group_id, Challenge.status.in_(statuses))
+    
     @hybrid_property
+    @memoized()
     def active_count(self):
-        return db.session.query(func.count(Challenge.id))\
-                .filter(Challenge.winner_id==None, Challenge.group_id==self.id, Challenge.utc_end_time > arrow.utcnow().naive).scalar()
+        return self.challenge_count(self.id, ('upcoming', 'active')).scalar()
 #     
 #     @hybrid_property
 #     def pending_count(self):
@@ -157,13 +191,18 @@ class Group(Base):
     
     @hybrid_property
     def incomplete_count(self):
-        return db.session.query(func.count(Challenge.id)).filter(Challenge.winner_id==None, Challenge.group_id==self.id).scalar()
+        return self.challenge_count(self.id, OPEN).scalar()
+    
+    @classmethod
+    def last_won(cls, group_id):
+        return db.session.query(Challenge)\
+                         .filter(Challenge.group_id==group_id, Challenge.winner_id!=None)\
+                         .order_by(Challenge.id.desc())
     
     @hybrid_property
+    @memoized()
     def last_winner(self):
-        last_challenge = db.session.query(Challenge)\
-                                   .filter(Challenge.group_id==self.id, Challenge.winner_id!=None)\
-                                   .order_by(Challenge.id.desc()).first()
+        last_challenge = self.last_won(self.id).first()
                                    
         if last_challenge:
             return last_challenge.winner
@@ -178,14 +217,10 @@ class Group(Base):
     
     @hybrid_method
     def leaders(self, top=None):
-        sub_q = db.session.query(func.max(FFARating.id).label("max_id"))\
-                          .filter(FFARating.group==self)\
-                          .group_by(FFARating.player_id).subquery()
-        
-        q = db.session.query(FFARating)\
-                      .filter(FFARating.group==self)\
-                      .join(sub_q, and_(FFARating.id == sub_q.c.max_id))\
-                      .order_by(FFARating._mu.desc())
+        q = db.session.query(GroupPlayerStats)\
+                      .options(joinedload(GroupPlayerStats.player))\
+                      .filter(GroupPlayerStats.group_id==self.id, GroupPlayerStats._mu!=None)\
+                      .order_by(GroupPlayerStats._mu.desc())
         
         if top: q = q.limit(top)
         
@@ -193,34 +228,7 @@ class Group(Base):
     
     @hybrid_property
     def leaderboard(self):
-        players = sorted([(p.username, p.id) for p in self.players], key=lambda player: player[0].lower())                
-        
-        results = {
-            'cols': [{'id': 'c_id', 'label': 'Challenge ID', 'type': 'string'}]
-                  + [{'id': 'p_id_{}'.format(p[1]), 'label': p[0], 'type': 'number'} for p in players],
-            'rows': []
-        }
-        
-        data = defaultdict(dict)
-        challenges = dict()
-        for r in db.session.query(FFARating).filter(FFARating.group==self):
-            data[r.challenge_id][r.player_id] = r.mu
-            if r.challenge: challenges[r.challenge_id] = r.challenge.name
-        
-        
-        results['rows'].append({'c': [{'v': 'Baseline' }] + [{'v': 25.00} for p in players]})
-        
-        for c in self.challenges[-5:]:
-            ds = data.get(c.id)
-            if ds:
-                results['rows'].append({'c': [{'v': c.name }] + [{'v': ds.get(p[1], None)} for p in players]})
-        
-        current_scores = {p.player.id: p.mu for p in self.leaders()}
-        #print(current_scores)
-        
-        results['rows'].append({'c': [{'v': 'Current Standings' }] + [{'v': current_scores.get(p[1], None)} for p in players]})
-        
-        return json.dumps(results)
+        return Leaderboard(self).json
           
     def __repr__(self):
         return self.name
@@ -228,6 +236,11 @@ class Group(Base):
 
 class Challenge(Base):
     __tablename__ = 'challenge'
+    __table_args__ = (db.Index('ix_challenge_group_id_winner_id_utc_end_time', 'group_id', 'winner_id', 'utc_end_time'),
+                      db.Index('ix_challenge_judge_id', 'judge_id'),
+                      db.Index('ix_challenge_group_id_status', 'group_id', 'status'),
+                      db.Index('ix_challenge_status_utc_start_time', 'status', 'utc_start_time'),
+                      db.Index('ix_challenge_status_utc_end_time', 'status', 'utc_end_time'))
     group_id = db.Column(db.Integer(), db.ForeignKey(Group.id))
     group = db.relationship('Group', backref=db.backref('challenges', lazy='dynamic', cascade='all, delete'))
     
@@ -247,11 +260,30 @@ class Challenge(Base):
     winner_id = db.Column(db.Integer(), db.ForeignKey(User.id))
     winner = db.relationship('User', foreign_keys=[winner_id], backref=db.backref('challenge_wins', lazy='dynamic', cascade='all, delete'))
     
+    # upcoming, active, pending or complete; set on every write and moved on at the start and
+    # end times by gifoff/lifecycle.py, so lists and counts can filter on it
+    status = db.Column(db.String(10), nullable=False, default='upcoming', server_default='upcoming')
+    
+    def current_status(self, at=None):
+        """ The status the times and winner give at `at`, utcnow by default. """
+        if self.winner_id:
+            return 'complete'
+        
+        at = arrow.get(at) if at else arrow.utcnow()
+        if self.utc_start_time and at < arrow.get(self.utc_start_time):
+            return 'upcoming'
+        if self.utc_end_time and at >= arrow.get(self.utc_end_time):
+            return 'pending'
+        
+        return 'active'
+    
     @hybrid_property
+    @memoized('utc_start_time')
     def start_time(self):
         return arrow.get(self.utc_start_time)
     
     @hybrid_property
+    @memoized('utc_end_time')
     def end_time(self):
         return arrow.get(self.utc_end_time)
         
@@ -264,6 +296,7 @@ class Challenge(Base):
 #         return get_count(Entry, challenge_id=self.id)
     
     @hybrid_property
+    @memoized('winner_id')
     def complete(self):
         if self.winner_id:
             return True
@@ -271,20 +304,23 @@ class Challenge(Base):
         return False
     
     @hybrid_property
+    @memoized('winner_id', 'utc_start_time')
     def upcoming(self):
-        if self.complete is False and arrow.utcnow() < self.start_time:
+        if self.complete is False and now() < self.start_time:
             return True
         
         return False
     
     @hybrid_property
+    @memoized('winner_id', 'utc_end_time')
     def pending(self):
-        if self.complete is False and arrow.utcnow() > self.end_time:
+        if self.complete is False and now() > self.end_time:
             return True
         
         return False
     
     @hybrid_property
+    @memoized('winner_id', 'utc_start_time', 'utc_end_time')
     def active(self):
         if True in (self.complete, self.pending, self.upcoming):
             return False
@@ -292,6 +328,7 @@ class Challenge(Base):
         return True
     
     @hybrid_property
+    @memoized('winner_id', 'utc_start_time', 'utc_end_time', 'judge_id')
     def status_tag(self):
         if self.upcoming:
             return ('<i class="fa fa-clock-o"></i> Starts {}'.format(self.starts_in), 'info')
@@ -305,6 +342,7 @@ class Challenge(Base):
         return False 
     
     @hybrid_property
+    @memoized('winner_id', 'utc_start_time', 'utc_end_time')
     def time_left(self):
         if self.active or self.upcoming:
             return self.end_time.humanize()
@@ -312,43 +350,38 @@ class Challenge(Base):
             return None
     
     @hybrid_property
+    @memoized('winner_id', 'utc_start_time')
     def starts_in(self):
         if self.upcoming:
             return self.start_time.humanize()
         else:
             return None
     
+    @hybrid_property
+    @memoized()
+    def scoreboard(self):
+        return ChallengeScoreboard(self)
+    
+    @hybrid_method
+    @memoized()
+    def user_entries(self, user):
+        return Entry.for_player(self, user)
+    
     @hybrid_property
     def players(self):
-        return [e.player for e in db.session.query(Entry).distinct(Entry.player_id).group_by(Entry.player_id).filter(Entry.challenge_id==self.id)]
+        return self.scoreboard.players
     
     @hybrid_property
     def high_score(self):
-        max_score = 0
-        winners = list()
-        for p in self.players:
-            p_score = db.session.query(func.sum(Entry.score)).filter(Entry.challenge_id==self.id, Entry.player==p).scalar()
-            if p_score:
-                if p_score > max_score:
-                    max_score = p_score
-                    winners = [p]
-                elif p_score == max_score:
-                    winners.append(p)
-        
-        dice = randint(0,len(winners)-1)
-        
-        return (round(max_score or 0,1), winners[dice])
+        return self.scoreboard.high_score
     
     @hybrid_method
     def player_score(self, p):
-        return round(db.session.query(func.sum(Entry.score)).filter(Entry.challenge_id==self.id, Entry.player==p).scalar() or 0,1)
+        return self.scoreboard.score(p)
     
     @hybrid_method
     def player_status(self, p):
-        entries = db.session.query(func.count(Entry.url)).filter(Entry.challenge_id==self.id, Entry.player==p).scalar() or 0
-        scored = db.session.query(func.count(Entry.score)).filter(Entry.challenge_id==self.id, Entry.player==p).scalar() or 0
-        
-        return (entries, scored)
+        return self.scoreboard.status(p)
     
     def __repr__(self):
         return '{}'.format(self.name)
@@ -356,18 +389,27 @@ class Challenge(Base):
     
 class Prompt(Base):
     __tablename__ = 'prompt'
+    __table_args__ = (db.Index('ix_prompt_challenge_id', 'challenge_id'),)
     challenge_id = db.Column(db.Integer(), db.ForeignKey(Challenge.id))
     challenge = db.relationship('Challenge', backref=db.backref('prompts', lazy='dynamic', cascade='all, delete'))
     
     prompt = db.Column(db.String(250), nullable=False, unique=False)
     
+    @classmethod
+    def ids_for(cls, challenge_id):
+        return db.session.query(cls.id).filter(cls.challenge_id==challenge_id)
+    
+    @classmethod
+    def best_score(cls, prompt_id):
+        return db.session.query(Entry.score).filter(Entry.prompt_id==prompt_id).order_by(Entry.score.desc())
+    
     @hybrid_property
     def high_score(self):
-        return db.session.query(Entry).with_entities(Entry.score).filter(Entry.prompt_id==self.id).order_by(Entry.score.desc()).first()[0]
+        return self.best_score(self.id).first()[0]
         
     @hybrid_method
     def user_entry(self, user):
-        return Entry.get_or_create(prompt_id=self.id, player=user)
+        return self.challenge.user_entries(user).get(self.id)
     
     def __repr__(self):
         return '{} > {}'.format(self.challenge.name, self.prompt)
@@ -375,6 +417,9 @@ class Prompt(Base):
     
 class Entry(Base):
     __tablename__ = 'entry'
+    __table_args__ = (db.Index('uq_entry_prompt_id_player_id', 'prompt_id', 'player_id', unique=True),
+                      db.Index('ix_entry_challenge_id_player_id', 'challenge_id', 'player_id'),
+                      db.Index('ix_entry_player_id', 'player_id'))
     prompt_id = db.Column(db.Integer(), db.ForeignKey(Prompt.id))
     prompt = db.relationship('Prompt', backref=db.backref('entries', lazy='dynamic', cascade='all, delete'))
     
@@ -384,11 +429,75 @@ class Entry(Base):
     url = db.Column(db.String(250), nullable=True, unique=False)
     score = db.Column(db.Float())
     
-    challenge_id = association_proxy('prompt', 'challenge_id')
+    # denormalized from prompt.challenge_id so challenge scoped queries skip the prompt table
+    challenge_id = db.Column(db.Integer(), db.ForeignKey(Challenge.id))
+    
+    # read from the start of the GIF when the url is validated (gifoff/gifs.py); null if unknown
+    width = db.Column(db.Integer())
+    height = db.Column(db.Integer())
+    frames = db.Column(db.Integer())
+    size = db.Column(db.Integer())
+    
+    # sha256 of the copy in the local GIF store (gifoff/gifstore.py), null until it's fetched
+    digest = db.Column(db.String(64))
+    
+    def set_gif(self, info):
+        """ Store a gifs.GifInfo's metadata alongside the url it was read from. """
+        self.width, self.height, self.frames, self.size = info.width, info.height, info.frames, info.size
+    
+    @property
+    def oversized(self):
+        return self.size is not None and self.size > current_app.config['GIF_OVERSIZE_BYTES']
+    
+    @classmethod
+    def player_entries(cls, challenge_id, player_id):
+        return cls.query.filter(cls.challenge_id==challenge_id, cls.player_id==player_id)
+    
+    @classmethod
+    def for_player(cls, challenge, player):
+        """ A player's entries for every prompt in a challenge keyed by prompt id.
+            Missing entries are created with one bulk insert and one commit; if a concurrent
+            first view inserted them first, the unique index rejects ours and theirs are read. """
+        def load():
+            return {e.prompt_id: e for e in cls.player_entries(challenge.id, player.id)}
+        
+        entries = load()
+        missing = [p_id for p_id, in Prompt.ids_for(challenge.id) if p_id not in entries]
+        
+        if missing:
+            try:
+                db.session.bulk_insert_mappings(cls, [dict(prompt_id=p_id, challenge_id=challenge.id, player_id=player.id)
+                                                      for p_id in missing])
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+            entries = load()
+        
+        return entries
     
     def __repr__(self):
         return '{}: {}'.format(self.prompt_id, self.player.username)
 
+
+@event.listens_for(Challenge, 'before_insert')
+@event.listens_for(Challenge, 'before_update')
+def set_challenge_status(mapper, connection, target):
+    state = db.inspect(target)
+    if state.persistent and not any(state.attrs[name].history.has_changes()
+                                    for name in ('winner', 'winner_id', 'utc_start_time', 'utc_end_time')):
+        return
+    
+    status = target.current_status()
+    # becoming pending is left to lifecycle.tick(), which sends the judge reminder once
+    if status != 'pending' or target.status == 'pending':
+        target.status = status
+
+
+@event.listens_for(Entry, 'before_insert')
+def set_entry_challenge(mapper, connection, target):
+    if target.challenge_id is None and target.prompt_id is not None:
+        target.challenge_id = connection.scalar(select([Prompt.challenge_id]).where(Prompt.id==target.prompt_id))
+
 class Tournament(Base):
     pass
 #     __tablename__ = 'tournament'
@@ -487,6 +596,8 @@ class TournamentVote(Base):
 
 class FFARating(Base):
     __tablename__ = 'ffa_rating'
+    __table_args__ = (db.Index('ix_ffa_rating_group_id_player_id_id', 'group_id', 'player_id', 'id'),
+                      db.Index('ix_ffa_rating_challenge_id', 'challenge_id'))
     
     group_id = db.Column(db.Integer(), db.ForeignKey(Group.id))
     group = db.relationship('Group', backref=db.backref('ffa_ratings', lazy='dynamic', cascade='all, delete'))
@@ -527,7 +638,70 @@ class FFARating(Base):
     
     def __repr__(self):
         return str(int(self.mu * 100))
-    
+
+
+class FFARatingCheckpoint(Base):
+    """ A player's last rating from FFARating history that has been compacted away.
+
+    One row per group and player; rating_id is the id of the ffa_rating row it stands in for
+    and folded counts the history rows it replaces.
+    """
+    __tablename__ = 'ffa_rating_checkpoint'
+    __table_args__ = (db.UniqueConstraint('group_id', 'player_id'),)
+
+    group_id = db.Column(db.Integer(), db.ForeignKey(Group.id), nullable=False)
+    group = db.relationship('Group', backref=db.backref('rating_checkpoints', lazy='dynamic', cascade='all, delete'))
+
+    player_id = db.Column(db.Integer(), db.ForeignKey(User.id), nullable=False)
+    player = db.relationship('User', backref=db.backref('rating_checkpoints', lazy='dynamic', cascade='all, delete'))
+
+    challenge_id = db.Column(db.Integer(), db.ForeignKey(Challenge.id))
+    rating_id = db.Column(db.Integer(), nullable=False)
+    folded = db.Column(db.Integer(), nullable=False, default=0)
+
+    _mu = db.Column(db.Float(), nullable=False)
+    _sigma = db.Column(db.Float(), nullable=False)
+
+    @hybrid_property
+    def mu(self):
+        return round(self._mu, 2)
+
+    @hybrid_property
+    def rating(self):
+        return trueskill.Rating(mu=self._mu, sigma=self._sigma)
+
+    def __repr__(self):
+        return str(int(self.mu * 100))
+
+
+class Outbox(Base):
+    """ A notification to mail, written in the transaction that makes the change it announces.
+
+    Rows hold the event, not the message: gifoff/outbox.py builds and sends them later,
+    claiming a batch by setting claim and pushing available_at out by a lease.
+    """
+    __tablename__ = 'outbox'
+    __table_args__ = (db.Index('ix_outbox_status_available_at', 'status', 'available_at'),
+                      db.Index('ix_outbox_claim', 'claim'))
+
+    kind = db.Column(db.String(40), nullable=False)
+
+    challenge_id = db.Column(db.Integer(), db.ForeignKey(Challenge.id), nullable=False)
+    challenge = db.relationship('Challenge', backref=db.backref('outbox', lazy='dynamic', cascade='all, delete'))
+
+    # request.url_root when written, so links can be built outside a request
+    base_url = db.Column(db.String(250))
+
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending, sent, failed
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    available_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+    claim = db.Column(db.String(32))
+    sent_at = db.Column(db.DateTime())
+    last_error = db.Column(db.String(250))
+
+    def __repr__(self):
+        return '{} {}: {}'.format(self.kind, self.challenge_id, self.status)
+
 
 class Rating(Base): # 1v1 rating
     __tablename__ = 'rating'
@@ -565,6 +739,153 @@ class Rating(Base): # 1v1 rating
     def __repr__(self):
         return str(int(self.mu * 100))
 
+class GroupPlayerStats(Base):
+    __tablename__ = 'group_player_stats'
+    __table_args__ = (db.UniqueConstraint('group_id', 'player_id'),
+                      db.Index('ix_group_player_stats_group_id_mu', 'group_id', '_mu'))
+    
+    group_id = db.Column(db.Integer(), db.ForeignKey(Group.id), nullable=False)
+    group = db.relationship('Group', backref=db.backref('player_stats', lazy='dynamic', cascade='all, delete'))
+    
+    player_id = db.Column(db.Integer(), db.ForeignKey(User.id), nullable=False)
+    player = db.relationship('User', backref=db.backref('group_stats_rows', lazy='dynamic', cascade='all, delete'))
+    
+    entries = db.Column(db.Integer(), nullable=False, default=0)
+    total_score = db.Column(db.Float(), nullable=False, default=0.0)
+    wins = db.Column(db.Integer(), nullable=False, default=0)
+    
+    # current rating, kept in step with FFARating history by User.update_group_rating
+    _mu = db.Column(db.Float(), nullable=True)
+    _sigma = db.Column(db.Float(), nullable=True)
+    
+    @hybrid_property
+    def avg_score(self):
+        return round((self.total_score or 0)/(self.entries or 1), 1)
+    
+    @hybrid_property
+    def mu(self):
+        return round(self._mu, 2) if self._mu is not None else None
+    
+    @hybrid_property
+    def sigma(self):
+        return round(self._sigma, 2) if self._sigma is not None else None
+    
+    @hybrid_property
+    def rating(self):
+        if self._mu is None:
+            return None
+        return trueskill.Rating(mu=self._mu, sigma=self._sigma)
+    
+    @rating.setter
+    def rating(self, obj):
+        self._mu = obj.mu
+        self._sigma = obj.sigma
+    
+    @classmethod
+    def latest_ratings(cls, group_id, player_ids=None):
+        """ Each player's newest FFARating row in a group. """
+        latest = db.session.query(func.max(FFARating.id).label("max_id")).filter(FFARating.group_id==group_id)
+        if player_ids is not None:
+            latest = latest.filter(FFARating.player_id.in_(player_ids))
+        latest = latest.group_by(FFARating.player_id).subquery()
+        
+        return db.session.query(FFARating).join(latest, FFARating.id==latest.c.max_id)
+    
+    @classmethod
+    def history_ratings(cls, group_id, player_ids=None):
+        """ Each player's rating from FFARating history keyed by player id: the latest row, or the
+            checkpoint for players whose whole history has been compacted. """
+        checkpoints = FFARatingCheckpoint.query.filter(FFARatingCheckpoint.group_id==group_id)
+        if player_ids is not None:
+            checkpoints = checkpoints.filter(FFARatingCheckpoint.player_id.in_(player_ids))
+        
+        ratings = {r.player_id: r.rating for r in cls.latest_ratings(group_id, player_ids)}
+        for checkpoint in checkpoints:
+            ratings.setdefault(checkpoint.player_id, checkpoint.rating)
+        
+        return ratings
+    
+    @classmethod
+    def rows(cls, group_id, player_ids):
+        return cls.query.filter(cls.group_id==group_id, cls.player_id.in_(player_ids))
+    
+    @classmethod
+    def for_players(cls, group_id, player_ids):
+        """ Existing rows keyed by player id, with new zeroed rows added to the session for the rest.
+            New rows start from the player's rating history, if they have any. """
+        rows = {s.player_id: s for s in cls.rows(group_id, player_ids)} if player_ids else {}
+        
+        missing = [player_id for player_id in player_ids if player_id not in rows]
+        ratings = cls.history_ratings(group_id, missing) if missing else {}
+        
+        for player_id in missing:
+            rows[player_id] = cls(group_id=group_id, player_id=player_id, entries=0, total_score=0.0, wins=0)
+            if player_id in ratings:
+                rows[player_id].rating = ratings[player_id]
+            db.session.add(rows[player_id])
+        
+        return rows
+    
+    @classmethod
+    def record_challenge(cls, challenge, board):
+        """ Fold a closing challenge's scoreboard into the group totals. Caller commits. """
+        rows = cls.for_players(challenge.group_id, list(board.totals.keys()))
+        
+        for player_id, totals in board.totals.items():
+            stats = rows[player_id]
+            stats.entries += totals.entries
+            stats.total_score += totals.score
+            if challenge.winner and player_id == challenge.winner.id:
+                stats.wins += 1
+        
+        return rows
+    
+    @classmethod
+    def record_score(cls, challenge, player_id, difference):
+        """ Fold a score changed after the challenge closed into the group totals. Caller commits. """
+        stats = cls.for_players(challenge.group_id, [player_id])[player_id]
+        stats.total_score += difference
+        
+        return stats
+    
+    @classmethod
+    def rebuild(cls, group):
+        """ Recompute every player's row for a group from completed challenges and rating history. Caller commits. """
+        completed = and_(Challenge.group_id==group.id, Challenge.winner_id!=None)
+        
+        totals = db.session.query(Entry.player_id, func.count(Entry.url), func.sum(Entry.score))\
+                           .join(Challenge, Challenge.id==Entry.challenge_id)\
+                           .filter(completed)\
+                           .group_by(Entry.player_id)
+        
+        wins = dict(db.session.query(Challenge.winner_id, func.count(Challenge.id))\
+                              .filter(completed)\
+                              .group_by(Challenge.winner_id))
+        
+        ratings = cls.history_ratings(group.id)
+
+        cls.query.filter(cls.group_id==group.id).delete(synchronize_session=False)
+        
+        rows = dict()
+        for player_id, entries, score in totals:
+            rows[player_id] = cls(group_id=group.id, player_id=player_id, entries=entries or 0, total_score=score or 0.0, wins=0)
+        
+        for player_id in set(wins) | set(ratings):
+            rows.setdefault(player_id, cls(group_id=group.id, player_id=player_id, entries=0, total_score=0.0, wins=0))
+        
+        for player_id, stats in rows.items():
+            stats.wins = wins.get(player_id, 0)
+            if player_id in ratings:
+                stats.rating = ratings[player_id]
+        
+        db.session.add_all(rows.values())
+        
+        return rows
+    
+    def __repr__(self):
+        return str(int(self.mu * 100)) if self._mu is not None else '-'
+
+
 # Define Role model
 class Role(Base, RoleMixin):
     __tablename__ = "role"
@@ -585,10 +906,155 @@ class UserRoles(Base):
     
 class GroupPlayers(Base):
     __tablename__ = "group_players"
+    __table_args__ = (db.Index('uq_group_players_group_id_user_id', 'group_id', 'user_id', unique=True),
+                      db.Index('ix_group_players_user_id', 'user_id'))
     user_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'))
     group_id = db.Column(db.Integer(), db.ForeignKey('group.id', ondelete='CASCADE'))
 
 class GroupAuthors(Base):
     __tablename__ = "group_authors"
+    __table_args__ = (db.Index('uq_group_authors_group_id_user_id', 'group_id', 'user_id', unique=True),
+                      db.Index('ix_group_authors_user_id', 'user_id'))
     user_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'))
-    group_id = db.Column(db.Integer(), db.ForeignKey('group.id', ondelete='CASCADE'))
\ No newline at end of file
+    group_id = db.Column(db.Integer(), db.ForeignKey('group.id', ondelete='CASCADE'))
+
+
+# Aggregates
+
+PlayerTotals = namedtuple('PlayerTotals', ['score', 'entries', 'scored', 'largest'])
+
+
+class ChallengeScoreboard:
+    """Every player's total score, entry count and scored count for a challenge,
+    loaded with a single GROUP BY over Entry. Use Challenge.scoreboard to get
+    the copy memoized for the current request.
+    """
+    def __init__(self, challenge):
+        self.challenge = challenge
+
+        self.totals = OrderedDict((player_id, PlayerTotals(score or 0, entries or 0, scored or 0, largest or 0))
+                                  for player_id, score, entries, scored, largest in self.totals_query(challenge.id))
+        self._players = None
+
+    @staticmethod
+    def totals_query(challenge_id):
+        return db.session.query(Entry.player_id, func.sum(Entry.score), func.count(Entry.url), func.count(Entry.score),
+                                func.max(Entry.size))\
+                         .filter(Entry.challenge_id==challenge_id)\
+                         .group_by(Entry.player_id)\
+                         .order_by(Entry.player_id)
+
+    @property
+    def players(self):
+        if self._players is None:
+            users = {u.id: u for u in User.query.filter(User.id.in_(self.totals.keys()))} if self.totals else {}
+            self._players = [users[player_id] for player_id in self.totals if player_id in users]
+
+        return self._players
+
+    def totals_for(self, p):
+        return self.totals.get(getattr(p, 'id', p), PlayerTotals(0, 0, 0, 0))
+
+    def score(self, p):
+        return round(self.totals_for(p).score, 1)
+
+    def status(self, p):
+        t = self.totals_for(p)
+        return (t.entries, t.scored)
+
+    @property
+    def high_score(self):
+        max_score = 0
+        winners = list()
+        for p in self.players:
+            p_score = self.totals_for(p).score
+            if p_score:
+                if p_score > max_score:
+                    max_score = p_score
+                    winners = [p]
+                elif p_score == max_score:
+                    winners.append(p)
+
+        if not winners:
+            return (0, None)
+
+        dice = randint(0,len(winners)-1)
+
+        return (round(max_score or 0,1), winners[dice])
+
+
+class Leaderboard:
+    """Google DataTable payload for a group's standings chart.
+
+    History for the last `last` challenges comes from a single joined query,
+    current standings from Group.leaders(). Serialized results are cached under
+    the group's generation, so a bump of it invalidates them.
+    """
+    # challenges charted by default; rating compaction always keeps at least this many
+    window = 5
+
+    def __init__(self, group, last=None):
+        self.group = group
+        self.last = last or self.window
+
+    @staticmethod
+    def cache_key(group_id):
+        return 'leaderboard_data{}_{}'.format(group_id, generation('group', group_id))
+
+    @property
+    def players_query(self):
+        return db.session.query(User.username, User.id)\
+                         .join(GroupPlayers, GroupPlayers.user_id==User.id)\
+                         .filter(GroupPlayers.group_id==self.group.id)
+
+    @property
+    def players(self):
+        return sorted(self.players_query, key=lambda player: player[0].lower())
+
+    @property
+    def history_query(self):
+        recent = db.session.query(Challenge.id)\
+                           .filter(Challenge.group_id==self.group.id)\
+                           .order_by(Challenge.id.desc())\
+                           .limit(self.last).subquery()
+
+        return db.session.query(Challenge.id, Challenge.name, FFARating.player_id, FFARating._mu)\
+                         .join(recent, recent.c.id==Challenge.id)\
+                         .join(FFARating, FFARating.challenge_id==Challenge.id)\
+                         .order_by(Challenge.id, FFARating.id)
+
+    @property
+    def history(self):
+        data = OrderedDict()
+        for c_id, c_name, player_id, mu in self.history_query:
+            data.setdefault(c_id, (c_name, dict()))[1][player_id] = round(mu, 2)
+
+        return data.values()
+
+    def build(self):
+        players = self.players
+
+        results = {
+            'cols': [{'id': 'c_id', 'label': 'Challenge ID', 'type': 'string'}]
+                  + [{'id': 'p_id_{}'.format(p[1]), 'label': p[0], 'type': 'number'} for p in players],
+            'rows': []
+        }
+
+        results['rows'].append({'c': [{'v': 'Baseline' }] + [{'v': 25.00} for p in players]})
+
+        for name, ds in self.history:
+            results['rows'].append({'c': [{'v': name }] + [{'v': ds.get(p[1], None)} for p in players]})
+
+        current_scores = {r.player_id: r.mu for r in self.group.leaders()}
+
+        results['rows'].append({'c': [{'v': 'Current Standings' }] + [{'v': current_scores.get(p[1], None)} for p in players]})
+
+        return json.dumps(results)
+
+    @property
+    def json(self):
+        return fetch('leaderboard_data{}_{}'.format(self.group.id, self.last),
+                     '{}_{}'.format(self.cache_key(self.group.id), self.last),
+                     self.build,
+                     timeout=current_app.config['CACHE_FRAGMENT_TIMEOUT'])
+
@@ -0,0 +1,441 @@
+"""Notification mail through the outbox table.
+
+Views call notify() before db_commit(), so the Outbox row commits or rolls back with the
+change it announces, and the request never builds or sends the message. Rows are sent
+in batches over one SMTP session by drain(): `flask drain-outbox` from a worker or cron,
+or, with OUTBOX_AUTODRAIN, a drainer thread in the web process that kick() wakes after a
+commit. Pending rows survive restarts; a row that fails is retried after
+OUTBOX_RETRY_BACKOFF seconds, doubling, and marked failed after OUTBOX_MAX_ATTEMPTS.
+
+Only players whose User.notifications is 'immediate' are mailed per row. The rest get an
+hourly or daily digest from drain_digests(): a batch of due readers is claimed, every row
+since each reader's watermark (User.digest_outbox_id) in their groups is read with one
+query, and the batch of digests goes out over one SMTP session. Ids aren't committed in
+order, so only rows OUTBOX_DIGEST_LAG seconds old are read: a later id committed first
+can't move the watermark past a row still in flight. A reader who switches back to
+'immediate' is sent a final digest straight away of the rows mailed out before the switch
+(User.digest_until); everything after it reaches them row by row.
+"""
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from uuid import uuid4
+
+import arrow
+from flask import current_app, request, has_request_context, url_for
+from flask_mail import Message
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.orm import contains_eager
+
+from .mail import dispatcher
+from .memo import clear
+from .models import db, db_commit, User, Challenge, GroupPlayers, Outbox
+from .tasks import KickedWorker
+
+DIGEST_PERIODS = OrderedDict([('hourly', timedelta(hours=1)), ('daily', timedelta(days=1))])
+
+
+# Messages, built at send time from the challenge as it is then
+
+def immediate(users):
+    return [u.email for u in users if u.notifications == 'immediate']
+
+
+def challenge_created(challenge):
+    config = current_app.config
+    group = challenge.group
+
+    bcc = immediate(group.players)
+    if not bcc:
+        return None
+
+    msg = Message("New Challenge Posted to {} at {}".format(group.name, config['APP_NAME']),
+                  sender=(config['APP_NAME'], config['MAIL_DEFAULT_SENDER']),
+                  recipients=[config['MAIL_DEFAULT_SENDER']],
+                  bcc=bcc)
+
+    msg.body = "New Challenge by {}: '{}'\n".format(challenge.author.username, challenge.name)
+    msg.body += "{}\n".format(challenge.description)
+    msg.body += "---\n"
+    msg.body += "The challenge starts at {} ({}) and will be judged by {}.\n".format(
+        arrow.get(challenge.utc_start_time).to(config['DEFAULT_TIMEZONE']).format('YYYY-MM-DD HH:mm'),
+        config['DEFAULT_TIMEZONE'], challenge.judge.username)
+    msg.body += "Get Started: {}\n".format(
+        url_for('main.challenge', group_id=group, challenge_id=challenge, _external=True))
+    msg.body += "---\n"
+    msg.body += "Group Invite Link: {}".format(url_for('main.join_group', uuid=group.pin, _external=True))
+
+    return msg
+
+
+def challenge_completed(challenge):
+    config = current_app.config
+
+    recipients = immediate([challenge.judge])
+    bcc = immediate(challenge.scoreboard.players)
+    if not recipients and not bcc:
+        return None
+
+    msg = Message("{}: Challenge '{}' completed! Come see the winner".format(config['APP_NAME'], challenge.name),
+                  sender=(config['APP_NAME'], config['MAIL_DEFAULT_SENDER']),
+                  recipients=recipients or [config['MAIL_DEFAULT_SENDER']],
+                  bcc=bcc)
+
+    msg.body = "{} by {} has completed.\n".format(challenge.name, challenge.author.username)
+    msg.body += "{} has humbly selected the winner to be... {} \n".format(challenge.judge.username,
+                                                                          challenge.winner.username)
+    msg.body += "---\n"
+    msg.body += "See {}'s and everyone else's entries at: {}\n".format(challenge.winner.username,
+                                                                       url_for('main.challenge',
+                                                                               group_id=challenge.group,
+                                                                               challenge_id=challenge,
+                                                                               _external=True))
+    msg.body += "---\n"
+    msg.body += "Group Invite Link: {}".format(url_for('main.join_group', uuid=challenge.group.pin, _external=True))
+
+    return msg
+
+
+def judge_reminder(challenge):
+    """ Goes out as it happens whatever the judge's notification setting, it's theirs to act on. """
+    config = current_app.config
+
+    msg = Message("{}: '{}' has ended and is ready to judge".format(config['APP_NAME'], challenge.name),
+                  sender=(config['APP_NAME'], config['MAIL_DEFAULT_SENDER']),
+                  recipients=[challenge.judge.email])
+
+    msg.body = "{} in {} has ended with {} players entered.\n".format(challenge.name, challenge.group.name,
+                                                                      len(challenge.scoreboard.players))
+    msg.body += "Score the entries and pick the winner at: {}".format(
+        url_for('main.challenge', group_id=challenge.group, challenge_id=challenge, _external=True))
+
+    return msg
+
+
+MESSAGES = dict(challenge_created=challenge_created, challenge_completed=challenge_completed,
+                judge_reminder=judge_reminder)
+
+
+# Digest entries, one short paragraph per row
+
+def created_line(challenge):
+    return "New challenge in {}: '{}' by {}, starting {} ({}) and judged by {}.\n{}".format(
+        challenge.group.name, challenge.name, challenge.author.username,
+        arrow.get(challenge.utc_start_time).to(current_app.config['DEFAULT_TIMEZONE']).format('YYYY-MM-DD HH:mm'),
+        current_app.config['DEFAULT_TIMEZONE'], challenge.judge.username,
+        url_for('main.challenge', group_id=challenge.group, challenge_id=challenge, _external=True))
+
+
+def completed_line(challenge):
+    return "'{}' in {} has completed: {} picked {} as the winner.\n{}".format(
+        challenge.name, challenge.group.name, challenge.judge.username, challenge.winner.username,
+        url_for('main.challenge', group_id=challenge.group, challenge_id=challenge, _external=True))
+
+
+DIGEST_LINES = dict(challenge_created=created_line, challenge_completed=completed_line)
+
+
+def notify(kind, challenge, hold=False):
+    """ Add an Outbox row for `kind` mail about `challenge` to the session. Caller commits.
+
+    A held row isn't sent until release(), or OUTBOX_HOLD seconds if that never comes.
+    """
+    base_url = request.url_root if has_request_context() else None
+    row = Outbox(kind=kind, challenge=challenge, base_url=base_url)
+    if hold:
+        row.available_at = datetime.utcnow() + timedelta(seconds=current_app.config['OUTBOX_HOLD'])
+    db.session.add(row)
+
+    return row
+
+
+def release(row_id):
+    """ Make a held row due now. """
+    Outbox.query.filter(Outbox.id==row_id, Outbox.status=='pending', Outbox.attempts==0)\
+                .update({Outbox.available_at: datetime.utcnow()}, synchronize_session=False)
+    db_commit()
+
+
+def build(row):
+    """ The message for an Outbox row, with links against the site it was written from. None if nobody wants it now. """
+    with current_app.test_request_context(base_url=row.base_url or current_app.config['OUTBOX_BASE_URL']):
+        return MESSAGES[row.kind](row.challenge)
+
+
+def build_digest(user, rows):
+    """ One message covering `rows` for a digest reader. """
+    config = current_app.config
+
+    # a final digest goes to a reader who is back on 'immediate'
+    period = user.notifications if user.notifications in DIGEST_PERIODS else 'last'
+    msg = Message("{}: your {} digest, {} update{}".format(config['APP_NAME'], period,
+                                                          len(rows), '' if len(rows) == 1 else 's'),
+                  sender=(config['APP_NAME'], config['MAIL_DEFAULT_SENDER']),
+                  recipients=[user.email])
+
+    with current_app.test_request_context(base_url=rows[-1].base_url or config['OUTBOX_BASE_URL']):
+        msg.body = "\n---\n".join(DIGEST_LINES[row.kind](row.challenge) for row in rows)
+        msg.body += "\n---\n"
+        msg.body += "Change how often you hear from us: {}".format(url_for('main.notifications', _external=True))
+
+    return msg
+
+
+def set_notifications(user, mode):
+    """ Switch a user's notification mode. Caller commits, then kicks the drainer.
+
+    A digest starts from the rows written after the switch. Leaving digests owes the reader
+    the rows since their last one that were already mailed out, and so never reached them;
+    they go in a final digest that is due at once.
+    """
+    now = datetime.utcnow()
+
+    if mode != 'immediate' and user.notifications == 'immediate':
+        if user.digest_until is None:
+            # rows up to now were mailed as they came, the first digest is a period away
+            user.digest_outbox_id = db.session.query(func.max(Outbox.id)).scalar() or 0
+            user.digest_attempts = 0
+        # else the final digest wasn't sent yet, and its rows go in the next regular one
+        user.digest_sent_at, user.digest_until = now, None
+    elif mode == 'immediate' and user.notifications != 'immediate' and user.digest_sent_at is not None:
+        user.digest_sent_at, user.digest_until, user.digest_attempts = now, now, 0
+
+    user.notifications = mode
+
+
+# Draining
+
+def due_rows(now, limit):
+    return db.session.query(Outbox.id)\
+                     .filter(Outbox.status=='pending', Outbox.available_at<=now)\
+                     .order_by(Outbox.available_at, Outbox.id)\
+                     .limit(limit)
+
+
+def claimed(token):
+    return Outbox.query.filter(Outbox.claim==token).order_by(Outbox.id)
+
+
+def claim(limit):
+    """ Take up to `limit` due rows for this drainer; others skip them until the lease runs out. """
+    now = datetime.utcnow()
+    token = uuid4().hex
+
+    due = [row_id for row_id, in due_rows(now, limit)]
+    if not due:
+        return []
+
+    Outbox.query.filter(Outbox.id.in_(due), Outbox.status=='pending', Outbox.available_at<=now)\
+                .update({Outbox.claim: token,
+                         Outbox.attempts: Outbox.attempts + 1,
+                         Outbox.available_at: now + timedelta(seconds=current_app.config['OUTBOX_LEASE'])},
+                        synchronize_session=False)
+    if not db_commit():
+        return []
+
+    return claimed(token).all()
+
+
+def failed(row, error):
+    config = current_app.config
+
+    row.claim = None
+    row.last_error = str(error)[:250]
+
+    if row.attempts >= config['OUTBOX_MAX_ATTEMPTS']:
+        row.status = 'failed'
+        current_app.logger.error('Outbox {} gave up after {} attempts: {}'.format(row.id, row.attempts, error))
+    else:
+        row.available_at = datetime.utcnow() + timedelta(seconds=config['OUTBOX_RETRY_BACKOFF'] * 2 ** (row.attempts - 1))
+
+
+def drain(limit=None):
+    """ Send one batch of due rows over one SMTP session, (sent, failed) counts. """
+    rows = claim(limit or current_app.config['OUTBOX_BATCH_SIZE'])
+    if not rows:
+        return 0, 0
+
+    built = []
+    for row in rows:
+        try:
+            built.append((row, build(row)))
+        except Exception as e:
+            current_app.logger.exception('Outbox {} could not be built'.format(row.id))
+            failed(row, e)
+
+    # a None message had only digest readers, nothing to send now
+    errors = {id(msg): error for msg, error in dispatcher.send_batch([msg for row, msg in built if msg is not None],
+                                                                      retries=0)}
+
+    now = datetime.utcnow()
+    for row, msg in built:
+        if id(msg) in errors:
+            failed(row, errors[id(msg)])
+        else:
+            row.status, row.sent_at, row.claim = 'sent', now, None
+
+    db_commit()
+    clear()
+
+    sent = len(built) - len(errors)
+    return sent, len(rows) - sent
+
+
+def digest_due(now):
+    """ Filter for digest readers whose period has passed since their last digest, and final digests. """
+    return or_(and_(User.notifications=='immediate', User.digest_sent_at<=now, User.digest_until!=None),
+               *[and_(User.notifications==mode, User.digest_sent_at<=now - period)
+                 for mode, period in DIGEST_PERIODS.items()])
+
+
+def start_digests(now):
+    """ Readers new to digests start at the newest row, so they aren't sent the whole history. """
+    newest = db.session.query(func.max(Outbox.id)).scalar() or 0
+
+    User.query.filter(User.notifications.in_(DIGEST_PERIODS), User.digest_sent_at==None)\
+              .update({User.digest_outbox_id: newest, User.digest_sent_at: now}, synchronize_session=False)
+
+
+def digest_rows(token):
+    """ Every (reader, row) a claimed batch of digests covers, in one query. """
+    # against the database clock, which wrote Outbox.date_created
+    settled = db.session.query(func.current_timestamp()).scalar() \
+              - timedelta(seconds=current_app.config['OUTBOX_DIGEST_LAG'])
+
+    return db.session.query(User, Outbox)\
+                     .join(GroupPlayers, GroupPlayers.user_id==User.id)\
+                     .join(Challenge, Challenge.group_id==GroupPlayers.group_id)\
+                     .join(Outbox, Outbox.challenge_id==Challenge.id)\
+                     .filter(User.digest_claim==token, Outbox.id>User.digest_outbox_id,
+                             Outbox.kind.in_(DIGEST_LINES),
+                             # a final digest covers what was mailed out before the switch
+                             or_(and_(User.digest_until==None, Outbox.date_created<=settled),
+                                 Outbox.sent_at<=User.digest_until))\
+                     .options(contains_eager(Outbox.challenge),
+                              contains_eager(Outbox.challenge).joinedload(Challenge.group),
+                              contains_eager(Outbox.challenge).joinedload(Challenge.author),
+                              contains_eager(Outbox.challenge).joinedload(Challenge.judge),
+                              contains_eager(Outbox.challenge).joinedload(Challenge.winner))\
+                     .order_by(User.id, Outbox.id)
+
+
+def drain_digests(limit=None):
+    """ Send one batch of due digests over one SMTP session, (sent, failed) counts.
+
+    Claiming sets digest_sent_at, which also keeps other drainers off the batch; a final
+    digest has no period, so it is held for OUTBOX_LEASE instead. A reader with nothing new
+    is skipped until their next period; one whose digest fails is retried with the same rows
+    after OUTBOX_RETRY_BACKOFF, doubling, and after OUTBOX_MAX_ATTEMPTS those rows are skipped
+    and the reader waits for their next period.
+    """
+    config = current_app.config
+    now = datetime.utcnow()
+    token = uuid4().hex
+
+    start_digests(now)
+
+    readers = OrderedDict()
+    while not readers:
+        due = [user_id for user_id, in db.session.query(User.id).filter(digest_due(now))
+                                                 .order_by(User.id)
+                                                 .limit(limit or config['OUTBOX_BATCH_SIZE'])]
+        if not due:
+            db_commit()
+            return 0, 0
+
+        lease = now + timedelta(seconds=config['OUTBOX_LEASE'])
+        User.query.filter(User.id.in_(due), digest_due(now))\
+                  .update({User.digest_claim: token,
+                           User.digest_sent_at: case([(User.notifications=='immediate', lease)], else_=now)},
+                          synchronize_session=False)
+        if not db_commit():
+            return 0, 0
+
+        for user, row in digest_rows(token):
+            readers.setdefault(user, []).append(row)
+
+        # readers with nothing new are done until their next period, or for good after a final digest
+        done = User.query.filter(User.digest_claim==token, User.notifications=='immediate')
+        if readers:
+            done = done.filter(~User.id.in_([user.id for user in readers]))
+        done.update({User.digest_until: None}, synchronize_session=False)
+        User.query.filter(User.digest_claim==token).update({User.digest_claim: None}, synchronize_session=False)
+
+    built, errors = [], dict()
+    for user, rows in readers.items():
+        try:
+            built.append((user, rows, build_digest(user, rows)))
+        except Exception as e:
+            current_app.logger.exception('Digest for user {} could not be built'.format(user.id))
+            errors[user] = e
+
+    readers_of = {id(msg): user for user, rows, msg in built}
+    for msg, error in dispatcher.send_batch([msg for user, rows, msg in built], retries=0):
+        errors[readers_of[id(msg)]] = error
+
+    for user, rows in readers.items():
+        if user not in errors:
+            user.digest_outbox_id, user.digest_attempts, user.digest_until = rows[-1].id, 0, None
+            continue
+
+        user.digest_attempts += 1
+        if user.digest_attempts >= config['OUTBOX_MAX_ATTEMPTS']:
+            current_app.logger.error('Digest for user {} gave up on outbox rows up to {} after {} attempts: {}'
+                                     .format(user.id, rows[-1].id, user.digest_attempts, errors[user]))
+            user.digest_outbox_id, user.digest_attempts, user.digest_until = rows[-1].id, 0, None
+        else:
+            # due again after the backoff; a final digest has no period
+            backoff = timedelta(seconds=config['OUTBOX_RETRY_BACKOFF'] * 2 ** (user.digest_attempts - 1))
+            user.digest_sent_at = now - DIGEST_PERIODS.get(user.notifications, timedelta(0)) + backoff
+
+    db_commit()
+
+    return len(readers) - len(errors), len(errors)
+
+
+def drain_all(limit=None):
+    """ drain(), then drain_digests(), until nothing is due, (sent, failed) totals. """
+    sent = failed_total = 0
+
+    for step in (drain, drain_digests):
+        while True:
+            batch_sent, batch_failed = step(limit)
+            if not batch_sent and not batch_failed:
+                break
+
+            sent += batch_sent
+            failed_total += batch_failed
+
+    return sent, failed_total
+
+
+class OutboxDrainer(KickedWorker):
+    """ One thread per process that drains the outbox when kicked, and every OUTBOX_POLL_INTERVAL for retries. """
+
+    name = 'outbox'
+
+    def init_app(self, app):
+        app.config.setdefault('OUTBOX_AUTODRAIN', True)
+        app.config.setdefault('OUTBOX_BATCH_SIZE', 50)
+        app.config.setdefault('OUTBOX_LEASE', 5*60)
+        app.config.setdefault('OUTBOX_MAX_ATTEMPTS', 5)
+        app.config.setdefault('OUTBOX_RETRY_BACKOFF', 60)
+        app.config.setdefault('OUTBOX_POLL_INTERVAL', 60)
+        app.config.setdefault('OUTBOX_DIGEST_LAG', 60)
+        app.config.setdefault('OUTBOX_HOLD', 10*60)
+        app.config.setdefault('OUTBOX_BASE_URL', 'http://localhost/')
+
+        app.extensions['outbox'] = self
+        super(OutboxDrainer, self).init_app(app)
+
+    def enabled(self):
+        """ Kicks are no-ops unless OUTBOX_AUTODRAIN. """
+        return self.app.config['OUTBOX_AUTODRAIN']
+
+    def interval(self):
+        return self.app.config['OUTBOX_POLL_INTERVAL']
+
+    def run(self):
+        drain_all()
+
+
+drainer = OutboxDrainer()
@@ -0,0 +1,230 @@
+from multiprocessing import Pool
+
+import trueskill
+from flask import current_app
+from sqlalchemy import func, and_, or_
+
+from .ffa import FFATrueSkill, np
+from .invalidation import stale
+from .models import db, Challenge, Entry, FFARating, FFARatingCheckpoint, GroupPlayerStats, Leaderboard
+
+
+def rating_env(params=None, backend=None):
+    """ TrueSkill environment built from the TRUESKILL config overrides.
+
+    With RATING_BACKEND = 'numpy' free-for-all matches are rated by FFATrueSkill.
+    """
+    if params is None:
+        params = current_app.config.get('TRUESKILL', {})
+    if backend is None:
+        backend = current_app.config.get('RATING_BACKEND', 'trueskill')
+
+    env = trueskill.TrueSkill(**params)
+
+    if backend == 'numpy' and np is None:
+        current_app.logger.warning("RATING_BACKEND is 'numpy' but numpy is not installed; rating with trueskill")
+
+    return FFATrueSkill(env) if backend == 'numpy' else env
+
+
+def ranked_players(scores):
+    """ Player ids eligible for rating in a challenge, best score first.
+
+    `scores` maps every player with an entry to their total; only players who scored are
+    ranked and nobody is rated unless more than one player entered.
+    """
+    if len(scores) < 2:
+        return []
+
+    scored = [(player_id, round(score or 0, 1)) for player_id, score in scores.items()]
+
+    return [player_id for player_id, score in sorted(scored, key=lambda entry: entry[1], reverse=True) if score > 0.0]
+
+
+def rate_challenge(challenge, board=None, stats=None):
+    """ Rate a closing challenge as one free-for-all match.
+
+    Current ratings come from group_player_stats in one query, the rating environment runs
+    once, the new FFARating history rows are bulk inserted and the stats rows updated in the
+    caller's transaction. Returns the new ratings keyed by player id; caller commits.
+    """
+    board = board or challenge.scoreboard
+    ranked = ranked_players({player_id: totals.score for player_id, totals in board.totals.items()})
+
+    if len(ranked) < 2:
+        return dict()
+
+    if stats is None:
+        stats = GroupPlayerStats.for_players(challenge.group_id, ranked)
+
+    env = rating_env()
+    current = [(stats[player_id].rating or env.create_rating(),) for player_id in ranked]
+    new_ratings = {player_id: group[0] for player_id, group in zip(ranked, env.rate(current))}
+
+    db.session.bulk_insert_mappings(FFARating, [dict(group_id=challenge.group_id,
+                                                     challenge_id=challenge.id,
+                                                     player_id=player_id,
+                                                     _mu=rating.mu,
+                                                     _sigma=rating.sigma) for player_id, rating in new_ratings.items()])
+
+    for player_id, rating in new_ratings.items():
+        stats[player_id].rating = rating
+
+    return new_ratings
+
+
+# Offline replay
+
+def group_history(group_id):
+    """ A group's completed challenges in play order as (challenge_id, {player_id: score}). """
+    q = db.session.query(Challenge.id, Entry.player_id, func.sum(Entry.score))\
+                  .join(Entry, Entry.challenge_id==Challenge.id)\
+                  .filter(Challenge.group_id==group_id, Challenge.winner_id!=None)\
+                  .group_by(Challenge.id, Challenge.utc_end_time, Entry.player_id)\
+                  .order_by(Challenge.utc_end_time, Challenge.id, Entry.player_id)
+
+    history = []
+    for challenge_id, player_id, score in q:
+        if not history or history[-1][0] != challenge_id:
+            history.append((challenge_id, dict()))
+        history[-1][1][player_id] = score or 0
+
+    return history
+
+
+def replay_group(job):
+    """ Process pool worker: replay one group's history without touching the database.
+
+    Returns (group_id, [(challenge_id, player_id, mu, sigma), ...]) in play order.
+    """
+    group_id, history, params, backend = job
+    env = rating_env(params, backend)
+
+    current = dict()
+    rows = []
+    for challenge_id, scores in history:
+        ranked = ranked_players(scores)
+        if len(ranked) < 2:
+            continue
+
+        new_ratings = env.rate([(current.get(player_id, env.create_rating()),) for player_id in ranked])
+
+        for player_id, group in zip(ranked, new_ratings):
+            current[player_id] = group[0]
+            rows.append((challenge_id, player_id, group[0].mu, group[0].sigma))
+
+    return group_id, rows
+
+
+def replay(group_ids, processes=None, params=None, backend=None):
+    """ Replay every group in `group_ids`, spread over a process pool. Yields replay_group results. """
+    if params is None:
+        params = current_app.config.get('TRUESKILL', {})
+    if backend is None:
+        backend = current_app.config.get('RATING_BACKEND', 'trueskill')
+
+    # histories are loaded here, in the app thread, and handed to workers as they arrive
+    jobs = ((group_id, group_history(group_id), params, backend) for group_id in group_ids)
+
+    if processes == 1:
+        for job in jobs:
+            yield replay_group(job)
+    else:
+        pool = Pool(processes)
+        try:
+            pending = [pool.apply_async(replay_group, (job,)) for job in jobs]
+            for result in pending:
+                yield result.get()
+        finally:
+            pool.close()
+            pool.join()
+
+
+def final_ratings(rows):
+    """ Last (mu, sigma) per player from replayed rows. """
+    return {player_id: (mu, sigma) for challenge_id, player_id, mu, sigma in rows}
+
+
+def write_replay(group_id, rows):
+    """ Replace a group's rating history and current ratings with replayed rows. Caller commits. """
+    FFARating.query.filter(FFARating.group_id==group_id).delete(synchronize_session=False)
+    FFARatingCheckpoint.query.filter(FFARatingCheckpoint.group_id==group_id).delete(synchronize_session=False)
+
+    db.session.bulk_insert_mappings(FFARating, [dict(group_id=group_id,
+                                                     challenge_id=challenge_id,
+                                                     player_id=player_id,
+                                                     _mu=mu,
+                                                     _sigma=sigma) for challenge_id, player_id, mu, sigma in rows])
+
+    ratings = final_ratings(rows)
+    stats = GroupPlayerStats.for_players(group_id, list(ratings.keys()))
+
+    for player_id, row in stats.items():
+        row._mu, row._sigma = ratings[player_id]
+
+    GroupPlayerStats.query.filter(GroupPlayerStats.group_id==group_id,
+                                  ~GroupPlayerStats.player_id.in_(list(ratings.keys()) or [0]))\
+                          .update({'_mu': None, '_sigma': None}, synchronize_session=False)
+
+    # the bulk statements skip the session's invalidation; bumped once the caller commits
+    stale('group', group_id)
+
+
+# History compaction
+
+def compact_history(group_id, keep):
+    """ Fold a group's FFARating rows for all but its newest `keep` challenges into checkpoints.
+
+    The newest challenges are picked the way Leaderboard.history picks them and `keep` never
+    drops below the chart window, so the chart and current ratings are unchanged. Each player's
+    latest folded row becomes (or replaces) their checkpoint. Rows with no challenge are never
+    charted and fold too, once they are older than every kept row. Returns rows removed; caller
+    commits.
+    """
+    keep = max(keep, Leaderboard.window)
+
+    oldest_kept = db.session.query(Challenge.id)\
+                            .filter(Challenge.group_id==group_id)\
+                            .order_by(Challenge.id.desc())\
+                            .offset(keep - 1).limit(1).scalar()
+
+    if oldest_kept is None:
+        return 0
+
+    # a player's newest row must stay their newest, so a newer unattached row waits
+    first_kept = db.session.query(func.min(FFARating.id))\
+                           .filter(FFARating.group_id==group_id, FFARating.challenge_id >= oldest_kept).scalar()
+    unattached = FFARating.challenge_id == None
+    if first_kept is not None:
+        unattached = and_(unattached, FFARating.id < first_kept)
+
+    folded = and_(FFARating.group_id==group_id, or_(FFARating.challenge_id < oldest_kept, unattached))
+
+    counts = dict(db.session.query(FFARating.player_id, func.count(FFARating.id))
+                            .filter(folded).group_by(FFARating.player_id))
+
+    if not counts:
+        return 0
+
+    latest = db.session.query(func.max(FFARating.id).label('max_id'))\
+                       .filter(folded)\
+                       .group_by(FFARating.player_id).subquery()
+
+    checkpoints = {c.player_id: c for c in FFARatingCheckpoint.query.filter(FFARatingCheckpoint.group_id==group_id,
+                                                                            FFARatingCheckpoint.player_id.in_(list(counts)))}
+
+    for rating in db.session.query(FFARating).join(latest, FFARating.id==latest.c.max_id):
+        checkpoint = checkpoints.get(rating.player_id)
+        if checkpoint is None:
+            checkpoint = FFARatingCheckpoint(group_id=group_id, player_id=rating.player_id, folded=0)
+            db.session.add(checkpoint)
+        elif checkpoint.rating_id > rating.id:
+            checkpoint.folded += counts[rating.player_id]
+            continue
+
+        checkpoint.challenge_id = rating.challenge_id
+        checkpoint.rating_id = rating.id
+        checkpoint.folded += counts[rating.player_id]
+        checkpoint._mu, checkpoint._sigma = rating._mu, rating._sigma
+
+    return FFARating.query.filter(folded).delete(synchronize_session=False)
@@ -0,0 +1,5 @@
+// stored entries render as a still poster; load the animation on demand
+$(document).on('click', 'img.gif-poster[data-animated]', function () {
+    var img = $(this);
+    img.attr('src', img.attr('data-animated')).removeAttr('data-animated').removeAttr('title');
+});
@@ -0,0 +1,151 @@
+import os
+import threading
+from abc import ABCMeta, abstractmethod
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+
+class TaskQueue(object):
+    """ Background calls on a bounded queue, run by a fixed number of daemon threads per process.
+
+    A burst of work can't start a thread per call: submit() drops the call when the queue
+    is full. Each call runs in its own app context, not the request's, so tasks take ids
+    rather than request state. Threads start with the first call in each process, again
+    after a fork. With a config prefix, <prefix>_WORKERS and <prefix>_QUEUE_SIZE size it.
+    """
+
+    def __init__(self, name, app=None, prefix=None, workers=2, size=100):
+        self.name = name
+        self.app = None
+        self.prefix = prefix
+        self.workers = workers
+        self.size = size
+        self.queue = None
+        self.threads = []
+        self.pid = None
+        self.lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+
+        if self.prefix:
+            app.config.setdefault(self.prefix + '_WORKERS', self.workers)
+            app.config.setdefault(self.prefix + '_QUEUE_SIZE', self.size)
+            self.workers = app.config[self.prefix + '_WORKERS']
+            self.size = app.config[self.prefix + '_QUEUE_SIZE']
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            # a forked child starts over: the parent's queued calls and threads aren't its own
+            self.pid = os.getpid()
+            self.queue = Queue(maxsize=self.size)
+            self.threads = [threading.Thread(name='{}-{}'.format(self.name, n), target=self.work)
+                            for n in range(self.workers)]
+            for thread in self.threads:
+                thread.daemon = True
+                thread.start()
+
+    def submit(self, func, *args):
+        """ Queue func(*args), False if the queue is full and the call was dropped. """
+        self.start()
+
+        try:
+            self.queue.put_nowait((func, args))
+        except Full:
+            self.app.logger.warning('{} queue full, dropped {}{}'.format(self.name, func.__name__, args))
+            return False
+
+        return True
+
+    def work(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                with self.app.app_context():
+                    func(*args)
+            except Exception:
+                self.app.logger.exception('Background task {} failed'.format(func.__name__))
+            finally:
+                self.queue.task_done()
+
+
+# close()'s announcements and other short jobs a request hands off
+background = TaskQueue('background', prefix='TASK')
+
+# abc.ABC, spelled so Python 2 takes it too
+ABC = ABCMeta('ABC', (object,), {})
+
+
+class KickedWorker(ABC):
+    """ One daemon thread per process that runs when kicked, and again after a timeout.
+
+    Subclasses name the thread and say whether it runs at all (enabled), how long it may
+    sleep (interval), and what one pass does (run). run() is called in an app context and
+    may return how many seconds to sleep instead of interval(). The thread starts with the
+    first kick in each process, again after a fork, and the first request kicks it.
+    A subclass missing interval() or run() can't be instantiated.
+    """
+
+    name = 'worker'
+
+    def __init__(self, app=None):
+        self.app = None
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.pid = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+
+        # work left over by the last process is picked up once this one serves a request
+        app.before_first_request(self.kick)
+
+    def enabled(self):
+        return True
+
+    @abstractmethod
+    def interval(self):
+        """ Seconds to sleep between passes when nothing kicks the thread. """
+
+    @abstractmethod
+    def run(self):
+        """ One pass; may return the seconds to sleep before the next. """
+
+    def kick(self):
+        """ Have this process's thread run now. No-op unless enabled(). """
+        if not self.enabled():
+            return
+
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                worker = threading.Thread(name=self.name, target=self.work)
+                worker.daemon = True
+                worker.start()
+
+        self.wakeup.set()
+
+    def work(self):
+        while True:
+            timeout = None
+            try:
+                with self.app.app_context():
+                    timeout = self.run()
+            except Exception:
+                self.app.logger.exception('Background worker {} failed'.format(self.name))
+
+            # a kick during run() leaves the event set, so the next pass starts straight away
+            self.wakeup.wait(self.interval() if timeout is None else timeout)
+            self.wakeup.clear()
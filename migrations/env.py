@@ -0,0 +1,52 @@
+import os
+import sys
+from logging.config import fileConfig
+
+from alembic import context
+from flask import Config
+from sqlalchemy import engine_from_config, pool
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, BASE_PATH)
+
+from gifoff.models import db
+
+config = context.config
+fileConfig(config.config_file_name)
+
+# same lookup order as create_app: config.py, then instance/config.py
+app_config = Config(BASE_PATH)
+app_config.from_object('config')
+app_config.from_pyfile(os.path.join('instance', 'config.py'), silent=True)
+
+config.set_main_option('sqlalchemy.url', app_config['SQLALCHEMY_DATABASE_URI'])
+
+target_metadata = db.metadata
+
+
+def run_migrations_offline():
+    context.configure(url=config.get_main_option('sqlalchemy.url'),
+                      target_metadata=target_metadata,
+                      literal_binds=True)
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    connectable = engine_from_config(config.get_section(config.config_ini_section),
+                                     prefix='sqlalchemy.',
+                                     poolclass=pool.NullPool)
+
+    with connectable.connect() as connection:
+        context.configure(connection=connection,
+                          target_metadata=target_metadata)
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,63 @@
+"""index pack for hot filters
+
+Revision ID: 0001
+Revises: 
+Create Date: 2026-10-18 09:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+INDEXES = [
+    ('ix_challenge_group_id_winner_id_utc_end_time', 'challenge', ['group_id', 'winner_id', 'utc_end_time'], False),
+    ('ix_challenge_judge_id', 'challenge', ['judge_id'], False),
+    ('ix_prompt_challenge_id', 'prompt', ['challenge_id'], False),
+    ('uq_entry_prompt_id_player_id', 'entry', ['prompt_id', 'player_id'], True),
+    ('ix_entry_player_id', 'entry', ['player_id'], False),
+    ('ix_ffa_rating_group_id_player_id_id', 'ffa_rating', ['group_id', 'player_id', 'id'], False),
+    ('ix_ffa_rating_challenge_id', 'ffa_rating', ['challenge_id'], False),
+    ('uq_group_players_group_id_user_id', 'group_players', ['group_id', 'user_id'], True),
+    ('ix_group_players_user_id', 'group_players', ['user_id'], False),
+    ('uq_group_authors_group_id_user_id', 'group_authors', ['group_id', 'user_id'], True),
+    ('ix_group_authors_user_id', 'group_authors', ['user_id'], False),
+]
+
+
+def remove_duplicate_members(table):
+    # keep the oldest row for each (group_id, user_id) before adding the unique index
+    op.execute(
+        'DELETE FROM {0} WHERE id NOT IN '
+        '(SELECT keep_id FROM (SELECT MIN(id) AS keep_id FROM {0} GROUP BY group_id, user_id) AS keep)'.format(table)
+    )
+
+
+def remove_duplicate_entries():
+    # concurrent first views could each create a player's empty entries; keep the oldest
+    # submitted one for each (prompt_id, player_id), or the oldest if none was submitted
+    op.execute(
+        'DELETE FROM entry WHERE prompt_id IS NOT NULL AND player_id IS NOT NULL AND id NOT IN '
+        '(SELECT keep_id FROM (SELECT COALESCE(MIN(CASE WHEN url IS NOT NULL THEN id END), MIN(id)) AS keep_id '
+        'FROM entry WHERE prompt_id IS NOT NULL AND player_id IS NOT NULL GROUP BY prompt_id, player_id) AS keep)'
+    )
+
+
+def upgrade():
+    remove_duplicate_members('group_players')
+    remove_duplicate_members('group_authors')
+    remove_duplicate_entries()
+
+    for name, table, columns, unique in INDEXES:
+        op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade():
+    for name, table, columns, unique in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
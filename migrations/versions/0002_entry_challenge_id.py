@@ -0,0 +1,34 @@
+"""denormalize entry.challenge_id
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 10:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('entry') as batch_op:
+        batch_op.add_column(sa.Column('challenge_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_entry_challenge_id', 'challenge', ['challenge_id'], ['id'])
+
+    op.execute('UPDATE entry SET challenge_id = (SELECT prompt.challenge_id FROM prompt WHERE prompt.id = entry.prompt_id)')
+
+    op.create_index('ix_entry_challenge_id_player_id', 'entry', ['challenge_id', 'player_id'])
+
+
+def downgrade():
+    op.drop_index('ix_entry_challenge_id_player_id', table_name='entry')
+
+    with op.batch_alter_table('entry') as batch_op:
+        batch_op.drop_constraint('fk_entry_challenge_id', type_='foreignkey')
+        batch_op.drop_column('challenge_id')
@@ -0,0 +1,43 @@
+"""ffa_rating_checkpoint for compacted rating history
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 12:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # a create_all() from newer code may have made it already
+    if 'ffa_rating_checkpoint' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table('ffa_rating_checkpoint',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('date_created', sa.DateTime(), nullable=True),
+                    sa.Column('date_modified', sa.DateTime(), nullable=True),
+                    sa.Column('group_id', sa.Integer(), nullable=False),
+                    sa.Column('player_id', sa.Integer(), nullable=False),
+                    sa.Column('challenge_id', sa.Integer(), nullable=True),
+                    sa.Column('rating_id', sa.Integer(), nullable=False),
+                    sa.Column('folded', sa.Integer(), nullable=False),
+                    sa.Column('_mu', sa.Float(), nullable=False),
+                    sa.Column('_sigma', sa.Float(), nullable=False),
+                    sa.ForeignKeyConstraint(['group_id'], ['group.id']),
+                    sa.ForeignKeyConstraint(['player_id'], ['user.id']),
+                    sa.ForeignKeyConstraint(['challenge_id'], ['challenge.id']),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('group_id', 'player_id'))
+
+
+def downgrade():
+    op.drop_table('ffa_rating_checkpoint')
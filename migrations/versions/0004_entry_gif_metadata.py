@@ -0,0 +1,32 @@
+"""GIF metadata on entry
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 15:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('entry') as batch_op:
+        batch_op.add_column(sa.Column('width', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('height', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('frames', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('size', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('entry') as batch_op:
+        batch_op.drop_column('size')
+        batch_op.drop_column('frames')
+        batch_op.drop_column('height')
+        batch_op.drop_column('width')
@@ -0,0 +1,26 @@
+"""digest of the locally stored GIF on entry
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 17:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('entry') as batch_op:
+        batch_op.add_column(sa.Column('digest', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('entry') as batch_op:
+        batch_op.drop_column('digest')
@@ -0,0 +1,46 @@
+"""outbox for notification mail
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 19:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # a create_all() from newer code may have made it already
+    if 'outbox' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table('outbox',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('date_created', sa.DateTime(), nullable=True),
+                    sa.Column('date_modified', sa.DateTime(), nullable=True),
+                    sa.Column('kind', sa.String(length=40), nullable=False),
+                    sa.Column('challenge_id', sa.Integer(), nullable=False),
+                    sa.Column('base_url', sa.String(length=250), nullable=True),
+                    sa.Column('status', sa.String(length=10), nullable=False),
+                    sa.Column('attempts', sa.Integer(), nullable=False),
+                    sa.Column('available_at', sa.DateTime(), nullable=False),
+                    sa.Column('claim', sa.String(length=32), nullable=True),
+                    sa.Column('sent_at', sa.DateTime(), nullable=True),
+                    sa.Column('last_error', sa.String(length=250), nullable=True),
+                    sa.ForeignKeyConstraint(['challenge_id'], ['challenge.id']),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_outbox_status_available_at', 'outbox', ['status', 'available_at'])
+    op.create_index('ix_outbox_claim', 'outbox', ['claim'])
+
+
+def downgrade():
+    op.drop_index('ix_outbox_claim', table_name='outbox')
+    op.drop_index('ix_outbox_status_available_at', table_name='outbox')
+    op.drop_table('outbox')
@@ -0,0 +1,36 @@
+"""notification mode and digest watermark on user
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 21:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.add_column(sa.Column('notifications', sa.String(length=10), nullable=False, server_default='immediate'))
+        batch_op.add_column(sa.Column('digest_sent_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('digest_outbox_id', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('digest_claim', sa.String(length=32), nullable=True))
+        batch_op.create_index('ix_user_notifications_digest_sent_at', ['notifications', 'digest_sent_at'])
+        batch_op.create_index('ix_user_digest_claim', ['digest_claim'])
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_index('ix_user_digest_claim')
+        batch_op.drop_index('ix_user_notifications_digest_sent_at')
+        batch_op.drop_column('digest_claim')
+        batch_op.drop_column('digest_outbox_id')
+        batch_op.drop_column('digest_sent_at')
+        batch_op.drop_column('notifications')
@@ -0,0 +1,48 @@
+"""stored challenge status
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 23:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('challenge') as batch_op:
+        batch_op.add_column(sa.Column('status', sa.String(length=10), nullable=False, server_default='upcoming'))
+
+    # challenges already past their end time start out pending without a judge reminder
+    challenge = sa.table('challenge',
+                         sa.column('status', sa.String),
+                         sa.column('winner_id', sa.Integer),
+                         sa.column('utc_start_time', sa.DateTime),
+                         sa.column('utc_end_time', sa.DateTime))
+    now = datetime.utcnow()
+    op.execute(challenge.update().values(status=sa.case([(challenge.c.winner_id != None, 'complete'),
+                                                         (challenge.c.utc_start_time > now, 'upcoming'),
+                                                         (challenge.c.utc_end_time <= now, 'pending')],
+                                                        else_='active')))
+
+    op.create_index('ix_challenge_group_id_status', 'challenge', ['group_id', 'status'])
+    op.create_index('ix_challenge_status_utc_start_time', 'challenge', ['status', 'utc_start_time'])
+    op.create_index('ix_challenge_status_utc_end_time', 'challenge', ['status', 'utc_end_time'])
+
+
+def downgrade():
+    op.drop_index('ix_challenge_status_utc_end_time', table_name='challenge')
+    op.drop_index('ix_challenge_status_utc_start_time', table_name='challenge')
+    op.drop_index('ix_challenge_group_id_status', table_name='challenge')
+
+    with op.batch_alter_table('challenge') as batch_op:
+        batch_op.drop_column('status')
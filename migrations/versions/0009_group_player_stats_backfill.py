@@ -0,0 +1,128 @@
+"""group_player_stats, backfilled from completed challenges and rating history
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-19 09:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+challenge = sa.table('challenge',
+                     sa.column('id', sa.Integer),
+                     sa.column('group_id', sa.Integer),
+                     sa.column('winner_id', sa.Integer))
+
+entry = sa.table('entry',
+                 sa.column('challenge_id', sa.Integer),
+                 sa.column('player_id', sa.Integer),
+                 sa.column('url', sa.String),
+                 sa.column('score', sa.Float))
+
+ffa_rating = sa.table('ffa_rating',
+                      sa.column('id', sa.Integer),
+                      sa.column('group_id', sa.Integer),
+                      sa.column('player_id', sa.Integer),
+                      sa.column('_mu', sa.Float),
+                      sa.column('_sigma', sa.Float))
+
+checkpoint = sa.table('ffa_rating_checkpoint',
+                      sa.column('group_id', sa.Integer),
+                      sa.column('player_id', sa.Integer),
+                      sa.column('_mu', sa.Float),
+                      sa.column('_sigma', sa.Float))
+
+
+def create_stats_table():
+    """ The table as GroupPlayerStats declares it, unless create_all already made it. """
+    if 'group_player_stats' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table('group_player_stats',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('date_created', sa.DateTime(), nullable=True),
+                    sa.Column('date_modified', sa.DateTime(), nullable=True),
+                    sa.Column('group_id', sa.Integer(), nullable=False),
+                    sa.Column('player_id', sa.Integer(), nullable=False),
+                    sa.Column('entries', sa.Integer(), nullable=False),
+                    sa.Column('total_score', sa.Float(), nullable=False),
+                    sa.Column('wins', sa.Integer(), nullable=False),
+                    sa.Column('_mu', sa.Float(), nullable=True),
+                    sa.Column('_sigma', sa.Float(), nullable=True),
+                    sa.ForeignKeyConstraint(['group_id'], ['group.id']),
+                    sa.ForeignKeyConstraint(['player_id'], ['user.id']),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('group_id', 'player_id'))
+    op.create_index('ix_group_player_stats_group_id_mu', 'group_player_stats', ['group_id', '_mu'])
+
+
+def upgrade():
+    create_stats_table()
+
+    # the same rows GroupPlayerStats.rebuild() writes, for every group at once
+    bind = op.get_bind()
+    completed = challenge.c.winner_id != None
+    rows = dict()
+
+    def row(group_id, player_id):
+        return rows.setdefault((group_id, player_id), dict(group_id=group_id, player_id=player_id, entries=0,
+                                                           total_score=0.0, wins=0, _mu=None, _sigma=None))
+
+    totals = sa.select([challenge.c.group_id, entry.c.player_id, sa.func.count(entry.c.url), sa.func.sum(entry.c.score)])\
+               .select_from(entry.join(challenge, challenge.c.id == entry.c.challenge_id))\
+               .where(completed)\
+               .group_by(challenge.c.group_id, entry.c.player_id)
+    for group_id, player_id, entries, score in bind.execute(totals):
+        if player_id is not None:
+            stats = row(group_id, player_id)
+            stats['entries'], stats['total_score'] = entries or 0, score or 0.0
+
+    wins = sa.select([challenge.c.group_id, challenge.c.winner_id, sa.func.count(challenge.c.id)])\
+             .where(completed)\
+             .group_by(challenge.c.group_id, challenge.c.winner_id)
+    for group_id, player_id, count in bind.execute(wins):
+        row(group_id, player_id)['wins'] = count
+
+    latest = sa.select([sa.func.max(ffa_rating.c.id).label('max_id')])\
+               .group_by(ffa_rating.c.group_id, ffa_rating.c.player_id).alias('latest')
+    ratings = sa.select([ffa_rating.c.group_id, ffa_rating.c.player_id, ffa_rating.c._mu, ffa_rating.c._sigma])\
+                .select_from(ffa_rating.join(latest, latest.c.max_id == ffa_rating.c.id))
+    rated = set()
+    for group_id, player_id, mu, sigma in bind.execute(ratings):
+        stats = row(group_id, player_id)
+        stats['_mu'], stats['_sigma'] = mu, sigma
+        rated.add((group_id, player_id))
+
+    # players whose whole history has been compacted keep their checkpoint rating
+    for group_id, player_id, mu, sigma in bind.execute(sa.select([checkpoint.c.group_id, checkpoint.c.player_id,
+                                                                   checkpoint.c._mu, checkpoint.c._sigma])):
+        if (group_id, player_id) not in rated:
+            stats = row(group_id, player_id)
+            stats['_mu'], stats['_sigma'] = mu, sigma
+
+    now = datetime.utcnow()
+    for stats in rows.values():
+        stats['date_created'] = stats['date_modified'] = now
+
+    stats_table = sa.table('group_player_stats', *[sa.column(name) for name in
+                                                   ('date_created', 'date_modified', 'group_id', 'player_id',
+                                                    'entries', 'total_score', 'wins', '_mu', '_sigma')])
+    op.execute(stats_table.delete())
+    if rows:
+        op.bulk_insert(stats_table, list(rows.values()))
+
+
+def downgrade():
+    # whether upgrade() made the table or found it from create_all, 0008 doesn't have it
+    op.drop_index('ix_group_player_stats_group_id_mu', table_name='group_player_stats')
+    op.drop_table('group_player_stats')
@@ -0,0 +1,26 @@
+"""final digest owed after switching back to immediate
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-21 09:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0011'
+down_revision = '0010'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.add_column(sa.Column('digest_until', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('digest_until')
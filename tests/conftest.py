@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+# config.py reads the environment once, when the first app is created
+ROOT = tempfile.mkdtemp(prefix='gifoff-tests-')
+os.environ.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(ROOT, 'gifoff.db'),
+                  SECRET_KEY='test', SECURITY_PASSWORD_SALT='test',
+                  APP_NAME='GifOff', APP_ADMIN='admin', APP_EMAIL='admin@example.com', APP_PASSWORD='password',
+                  MAIL_DEFAULT_SENDER='gifoff@example.com', DEBUG='0', CACHE_TYPE='simple',
+                  GIF_STORE_DIR=os.path.join(ROOT, 'gifs'), OUTBOX_AUTODRAIN='0', CHALLENGE_AUTOTICK='0')
+
+
+@pytest.fixture(scope='session')
+def app():
+    """ One app for the session: the extensions are module globals and register once. """
+    from gifoff.factories.app import create_app
+
+    app = create_app()
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+
+    yield app
+
+    shutil.rmtree(ROOT, ignore_errors=True)
+
+
+@pytest.fixture
+def db(app):
+    """ The database in an app context, emptied again after the test. """
+    from gifoff.models import db
+
+    with app.app_context():
+        yield db
+
+        db.session.remove()
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+
+
+@pytest.fixture
+def make_challenge(db):
+    """ A challenge in a new group whose owner is its author, judge and only player. """
+    from gifoff.models import User, Group, Challenge
+
+    def make(name='challenge', owner=None, **kwargs):
+        if owner is None:
+            owner = User(username=name, email='{}@example.com'.format(name), password='x', active=True)
+        group = Group(owner=owner, name='{} group'.format(name), pin='{}-pin'.format(name))
+        group.players.append(owner)
+
+        now = datetime.utcnow()
+        kwargs.setdefault('utc_start_time', now - timedelta(days=1))
+        kwargs.setdefault('utc_end_time', now + timedelta(days=1))
+        challenge = Challenge(group=group, author=owner, judge=owner, name=name, **kwargs)
+
+        db.session.add(challenge)
+        db.session.commit()
+        return challenge
+
+    return make
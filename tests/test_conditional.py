@@ -0,0 +1,77 @@
+import pytest
+
+from gifoff.cache import bump
+
+
+@pytest.fixture
+def page(app, db, make_challenge):
+    """ A logged in player's client and the URL of their group page. """
+    challenge = make_challenge('conditional')
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = str(challenge.author.id)
+        session['_fresh'] = True
+
+    return client, '/{}'.format(challenge.group_id), challenge
+
+
+def test_unchanged_page_is_not_modified(page):
+    client, url, challenge = page
+
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    again = client.get(url, headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+    assert again.headers['ETag'] == etag
+
+
+def test_changed_group_gets_a_new_etag(page):
+    client, url, challenge = page
+    etag = client.get(url).headers['ETag']
+
+    bump('group', challenge.group_id)
+
+    changed = client.get(url, headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_etag_is_per_viewer(app, db, page, make_challenge):
+    client, url, challenge = page
+    etag = client.get(url).headers['ETag']
+
+    # the same page seen by another member of the group
+    other = make_challenge('other').author
+    challenge.group.players.append(other)
+    db.session.commit()
+
+    viewer = app.test_client()
+    with viewer.session_transaction() as session:
+        session['user_id'] = str(other.id)
+        session['_fresh'] = True
+
+    response = viewer.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_responses_are_private_and_revalidated(page):
+    client, url, challenge = page
+    response = client.get(url)
+
+    assert response.cache_control.private
+    assert response.cache_control.no_cache
+    assert response.last_modified is not None
+
+
+def test_pending_flash_skips_the_check(page):
+    client, url, challenge = page
+    etag = client.get(url).headers['ETag']
+
+    with client.session_transaction() as session:
+        session['_flashes'] = [('success', 'Saved')]
+
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 200
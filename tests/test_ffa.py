@@ -0,0 +1,59 @@
+import random
+
+import pytest
+import trueskill
+
+from gifoff.ffa import FFATrueSkill, TOLERANCE, np
+
+pytestmark = pytest.mark.skipif(np is None, reason='the numpy backend needs numpy')
+
+
+def field(env, size, seed):
+    rng = random.Random(seed)
+    return [(env.create_rating(rng.gauss(env.mu, env.sigma / 2), rng.uniform(env.sigma / 4, env.sigma)),)
+            for _ in range(size)]
+
+
+def assert_agrees(reference, fast):
+    for r, f in zip(reference, fast):
+        assert abs(r[0].mu - f[0].mu) <= TOLERANCE
+        assert abs(r[0].sigma - f[0].sigma) <= TOLERANCE
+
+
+@pytest.mark.parametrize('size', [2, 3, 10])
+def test_agrees_with_trueskill(size):
+    env = trueskill.TrueSkill()
+    groups = field(env, size, size)
+
+    assert_agrees(env.rate(groups), FFATrueSkill(env).rate(groups))
+
+
+@pytest.mark.parametrize('size', [50, 200])
+def test_agrees_with_trueskill_on_large_fields(size):
+    # the default draw margin runs trueskill out of float range on fields this size
+    env = trueskill.TrueSkill(draw_probability=0)
+    groups = field(env, size, size)
+
+    assert_agrees(env.rate(groups), FFATrueSkill(env).rate(groups))
+
+
+def test_ranks_and_dict_groups():
+    env = trueskill.TrueSkill()
+    groups = [{'player-{}'.format(n): rating} for n, (rating,) in enumerate(field(env, 6, 1))]
+    ranks = [3, 0, 5, 1, 4, 2]
+
+    reference = env.rate(groups, ranks)
+    fast = FFATrueSkill(env).rate(groups, ranks)
+
+    for r, f in zip(reference, fast):
+        assert list(r) == list(f)
+        assert_agrees([list(r.values())], [list(f.values())])
+
+
+def test_ties_fall_back_to_trueskill():
+    env = trueskill.TrueSkill()
+    groups = field(env, 4, 2)
+    ffa = FFATrueSkill(env)
+
+    assert not ffa.supports(groups, ranks=[0, 1, 1, 2])
+    assert ffa.rate(groups, [0, 1, 1, 2]) == env.rate(groups, [0, 1, 1, 2])
@@ -0,0 +1,78 @@
+import struct
+
+import pytest
+
+from gifoff.gifs import is_gif, parse, first_frame, content_size
+
+
+def gif(width, height, frames, signature=b'GIF89a', pad=0):
+    """ A GIF with a global color table, a looping extension and `frames` one-block images. """
+    out = [signature + struct.pack('<HHBBB', width, height, 0xF7, 0, 0) + bytes(768),
+           b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00']
+    for n in range(frames):
+        out.append(b'\x21\xf9\x04\x04\x0a\x00\x00\x00')
+        out.append(b'\x2c' + struct.pack('<HHHHB', 0, 0, width, height, 0) + b'\x08')
+        out.extend(b'\xff' + bytes(255) for _ in range(pad))
+        out.append(b'\x02\x4c\x01\x00')
+    out.append(b'\x3b')
+    return b''.join(out)
+
+
+class Response(object):
+    def __init__(self, status_code, **headers):
+        self.status_code = status_code
+        self.headers = {name.replace('_', '-'): value for name, value in headers.items()}
+
+
+@pytest.mark.parametrize('data, expected', [
+    (gif(1, 1, 1), True),
+    (gif(1, 1, 1, signature=b'GIF87a'), True),
+    (gif(1, 1, 1)[:13], True),
+    (gif(1, 1, 1)[:12], False),
+    (b'\x89PNG\r\n\x1a\n' + bytes(16), False),
+    (b'', False),
+])
+def test_is_gif(data, expected):
+    assert is_gif(data) is expected
+
+
+def test_parse_reads_size_and_frames():
+    assert parse(gif(320, 240, 3)) == (320, 240, 3)
+
+
+def test_parse_counts_frames_starting_in_the_prefix():
+    data = gif(10, 10, 5, pad=4)
+
+    # a prefix that cuts the third frame short still counts it, and none after it
+    third = data.index(b'\x2c', data.index(b'\x2c', data.index(b'\x2c') + 1) + 1)
+    assert parse(data[:third + 20]) == (10, 10, 3)
+
+
+def test_parse_refuses_other_formats():
+    assert parse(b'\x89PNG\r\n\x1a\n' + bytes(16)) is None
+    assert parse(b'GIF89') is None
+
+
+def test_first_frame_is_a_one_frame_gif():
+    poster = first_frame(gif(64, 48, 4, pad=2))
+
+    assert parse(poster) == (64, 48, 1)
+    assert poster.endswith(b'\x3b')
+
+
+def test_first_frame_needs_the_whole_image():
+    data = gif(64, 48, 2, pad=2)
+
+    assert first_frame(data[:data.index(b'\x2c') + 100]) is None
+
+
+@pytest.mark.parametrize('response, read, expected', [
+    (Response(206, content_range='bytes 0-65535/1048576'), 65536, 1048576),
+    (Response(206, content_range='bytes 0-65535/*'), 65536, None),
+    (Response(206), 65536, None),
+    (Response(200, content_length='2048'), 2048, 2048),
+    (Response(200), 2048, 2048),
+    (Response(200), None, None),
+])
+def test_content_size(response, read, expected):
+    assert content_size(response, read) == expected
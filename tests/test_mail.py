@@ -0,0 +1,84 @@
+import smtplib
+
+import pytest
+from flask_mail import Message, BadHeaderError
+
+from gifoff import mail
+from gifoff.mail import dispatcher, rejected
+
+
+@pytest.mark.parametrize('error, expected', [
+    (smtplib.SMTPDataError(550, b'message refused'), True),
+    (smtplib.SMTPDataError(451, b'try again later'), False),
+    (smtplib.SMTPSenderRefused(553, b'bad sender', 'gifoff@example.com'), True),
+    (smtplib.SMTPSenderRefused(421, b'closing', 'gifoff@example.com'), False),
+    (smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'no such user')}), True),
+    (smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'no such user'),
+                                    'b@example.com': (452, b'mailbox full')}), False),
+    (BadHeaderError('newline in subject'), True),
+])
+def test_rejected_by_reply_code(error, expected):
+    assert rejected(error) is expected
+
+
+class Connection(object):
+    """ An SMTP session that raises each message's queued outcomes in turn; None sends it. """
+
+    def __init__(self, outcomes, sent):
+        self.outcomes, self.sent = outcomes, sent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def send(self, msg):
+        outcome = self.outcomes[msg.subject].pop(0)
+        if outcome is not None:
+            raise outcome
+        self.sent.append(msg.subject)
+
+
+@pytest.fixture
+def session(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAIL_RETRY_BACKOFF', 0)
+    sent, outcomes = [], {}
+    monkeypatch.setattr(mail.mail, 'connect', lambda: Connection(outcomes, sent))
+
+    with app.app_context():
+        yield outcomes, sent
+
+
+def test_temporary_refusal_is_retried_after_the_rest(session):
+    outcomes, sent = session
+    outcomes.update(greylisted=[smtplib.SMTPDataError(451, b'later'), None], fine=[None])
+
+    failures = dispatcher.send_batch([Message('greylisted', recipients=['a@example.com']),
+                                      Message('fine', recipients=['b@example.com'])], retries=1)
+
+    assert failures == []
+    assert sent == ['fine', 'greylisted']
+
+
+def test_permanent_refusal_is_not_retried(session):
+    outcomes, sent = session
+    refused = smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'no such user')})
+    outcomes.update(unknown=[refused], fine=[None])
+
+    failures = dispatcher.send_batch([Message('unknown', recipients=['a@example.com']),
+                                      Message('fine', recipients=['b@example.com'])], retries=3)
+
+    assert [(msg.subject, error) for msg, error in failures] == [('unknown', refused)]
+    assert sent == ['fine']
+
+
+def test_temporary_refusal_fails_once_retries_run_out(session):
+    outcomes, sent = session
+    busy = smtplib.SMTPSenderRefused(421, b'busy', 'gifoff@example.com')
+    outcomes.update(busy=[busy, busy])
+
+    failures = dispatcher.send_batch([Message('busy', recipients=['a@example.com'])], retries=1)
+
+    assert [(msg.subject, error) for msg, error in failures] == [('busy', busy)]
+    assert sent == []
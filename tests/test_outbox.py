@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+from gifoff.models import Outbox
+from gifoff.outbox import notify, release, claim, failed
+
+
+def add_rows(db, challenge, count=1, **kwargs):
+    rows = [notify('challenge_created', challenge, **kwargs) for _ in range(count)]
+    db.session.commit()
+    return rows
+
+
+def test_claim_leases_due_rows(app, db, make_challenge):
+    add_rows(db, make_challenge(), 3)
+
+    before = datetime.utcnow()
+    rows = claim(10)
+
+    assert len(rows) == 3
+    assert len({row.claim for row in rows}) == 1
+    assert all(row.attempts == 1 for row in rows)
+    lease = timedelta(seconds=app.config['OUTBOX_LEASE'])
+    assert all(row.available_at >= before + lease for row in rows)
+
+    # leased rows are skipped by the next drainer
+    assert claim(10) == []
+
+
+def test_claim_takes_oldest_first_up_to_limit(db, make_challenge):
+    first, second, third = add_rows(db, make_challenge(), 3)
+
+    assert [row.id for row in claim(2)] == [first.id, second.id]
+    assert [row.id for row in claim(2)] == [third.id]
+
+
+def test_expired_lease_is_claimed_again(db, make_challenge):
+    row, = add_rows(db, make_challenge())
+    token = claim(1)[0].claim
+
+    # the drainer holding it died; its lease runs out
+    Outbox.query.filter(Outbox.id==row.id).update({Outbox.available_at: datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+
+    again, = claim(1)
+    assert again.id == row.id
+    assert again.attempts == 2
+    assert again.claim != token
+
+
+def test_held_row_waits_for_release(db, make_challenge):
+    row, = add_rows(db, make_challenge(), hold=True)
+
+    assert claim(1) == []
+
+    release(row.id)
+    assert [r.id for r in claim(1)] == [row.id]
+
+
+def test_release_leaves_claimed_rows_alone(db, make_challenge):
+    row, = add_rows(db, make_challenge())
+    claimed, = claim(1)
+    leased = claimed.available_at
+
+    release(row.id)
+    db.session.expire_all()
+
+    assert Outbox.query.get(row.id).available_at == leased
+
+
+def test_failed_backs_off_then_gives_up(app, db, make_challenge):
+    row, = add_rows(db, make_challenge())
+    backoff = app.config['OUTBOX_RETRY_BACKOFF']
+
+    delays = []
+    for attempt in range(1, app.config['OUTBOX_MAX_ATTEMPTS']):
+        row, = claim(1)
+        before = datetime.utcnow()
+        failed(row, 'refused')
+        db.session.commit()
+
+        assert row.status == 'pending' and row.claim is None
+        delays.append(round((row.available_at - before).total_seconds() / backoff))
+
+        Outbox.query.filter(Outbox.id==row.id).update({Outbox.available_at: datetime.utcnow()})
+        db.session.commit()
+
+    assert delays == [2 ** n for n in range(len(delays))]
+
+    row, = claim(1)
+    failed(row, 'refused')
+    db.session.commit()
+
+    assert row.status == 'failed'
+    assert row.last_error == 'refused'
+    assert claim(1) == []
@@ -0,0 +1,29 @@
+from click.testing import CliRunner
+from flask.cli import ScriptInfo
+
+from gifoff.commands import full_scans
+
+
+def plan(*details):
+    return [(n, 0, 0, detail) for n, detail in enumerate(details)]
+
+
+def test_full_scans_flags_hot_tables_only():
+    assert full_scans(plan('SCAN TABLE entry', 'SCAN TABLE role')) == ['SCAN TABLE entry']
+    assert full_scans(plan('SEARCH TABLE entry USING INDEX ix_entry_challenge_id (challenge_id=?)')) == []
+
+
+def test_full_scans_flags_covering_index_scans_unless_allowed():
+    covering = 'SCAN TABLE ffa_rating_1 USING COVERING INDEX ix_ffa_rating_group_id_player_id_id'
+
+    assert full_scans(plan(covering)) == [covering]
+    assert full_scans(plan(covering), allowed=('ffa_rating',)) == []
+    assert full_scans(plan('SCAN ffa_rating'), allowed=('ffa_rating',)) == ['SCAN ffa_rating']
+
+
+def test_hot_queries_use_indexes(app, db):
+    """ The explain-queries gate: no hot query scans a growing table against the models' schema. """
+    result = CliRunner().invoke(app.cli.commands['explain-queries'], obj=ScriptInfo(create_app=lambda info: app))
+
+    assert result.exit_code == 0, result.output
+    assert 'FAIL' not in result.output